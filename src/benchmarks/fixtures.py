@@ -0,0 +1,275 @@
+import logging as log
+import math
+import zipfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import osmium
+import rasterio as rio
+import shapely
+from dataclasses import dataclass
+from pathlib import Path
+
+# centre of every synthetic city, any location works as nothing is downloaded
+CENTRE = (8.40, 49.01)
+# number of blocks per side and number of bus routes of the predefined city sizes
+SIZES = {
+    "small": (15, 4),
+    "medium": (30, 8),
+    "large": (60, 16),
+}
+METRES_PER_DEGREE = 111320
+
+
+@dataclass
+class City:
+    name: str
+    place: gpd.GeoDataFrame
+    osm_path: Path
+    gtfs_path: Path
+    population_path: Path
+
+
+def make_city(
+    directory: Path,
+    name: str,
+    blocks: int,
+    routes: int,
+    block_metres: float = 200,
+    seed: int = 0,
+) -> City:
+    """
+    Generates a synthetic city with a grid of streets, bus routes along them and a population raster.
+    The same arguments always produce identical files, existing files are reused.
+    param: directory: folder the fixtures are written to
+    param: name: name of the city, used for the file names
+    param: blocks: number of street blocks per side
+    param: routes: number of bus routes, alternating between east-west and north-south streets
+    param: block_metres: length of a block
+    param: seed: seed of the population noise
+    return: City with its place outline and the paths of the fixtures
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    lons, lats = street_coordinates(blocks, block_metres)
+    place = gpd.GeoDataFrame(
+        {"name": [name]},
+        geometry=[shapely.box(lons[0], lats[0], lons[-1], lats[-1])],
+        crs="EPSG:4326",
+    )
+    city = City(
+        name=name,
+        place=place,
+        osm_path=Path(directory, f"{name}.osm.pbf"),
+        gtfs_path=Path(directory, f"{name}_gtfs.zip"),
+        population_path=Path(directory, f"{name}_population.tif"),
+    )
+    if not city.osm_path.exists():
+        street_grid_pbf(city.osm_path, lons, lats)
+    if not city.gtfs_path.exists():
+        bus_feed(city.gtfs_path, lons, lats, routes)
+    if not city.population_path.exists():
+        population_raster(city.population_path, place.total_bounds, seed=seed)
+    log.info(f"Fixtures of {name} with {blocks}x{blocks} blocks and {routes} routes in {directory}")
+    return city
+
+
+def make_cities(directory: Path, sizes: list[str]) -> list[City]:
+    """Generates the fixtures of predefined city sizes, see SIZES"""
+    return [
+        make_city(Path(directory, size), size, blocks=SIZES[size][0], routes=SIZES[size][1])
+        for size in sizes
+    ]
+
+
+def street_coordinates(blocks: int, block_metres: float) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the longitudes and latitudes of the street grid, centred on CENTRE"""
+    lon, lat = CENTRE
+    lat_step = block_metres / METRES_PER_DEGREE
+    lon_step = lat_step / math.cos(math.radians(lat))
+    offsets = np.arange(blocks + 1) - blocks / 2
+    return lon + offsets * lon_step, lat + offsets * lat_step
+
+
+def street_grid_pbf(path: Path, lons: np.ndarray, lats: np.ndarray) -> None:
+    """
+    Writes a grid of walkable streets as osm.pbf, every fifth street is a primary road.
+    param: path: file to write
+    param: lons: longitudes of the north-south streets
+    param: lats: latitudes of the east-west streets
+    """
+    def node_id(row: int, column: int) -> int:
+        return row * len(lons) + column + 1
+
+    temporary_path = Path(path).with_suffix(".tmp.pbf")
+    temporary_path.unlink(missing_ok=True)
+    with osmium.SimpleWriter(str(temporary_path)) as writer:
+        for row, lat in enumerate(lats):
+            for column, lon in enumerate(lons):
+                writer.add_node(
+                    osmium.osm.mutable.Node(
+                        id=node_id(row, column), location=(lon, lat), version=1
+                    )
+                )
+        way_id = 1
+        for row in range(len(lats)):
+            writer.add_way(
+                osmium.osm.mutable.Way(
+                    id=way_id,
+                    nodes=[node_id(row, column) for column in range(len(lons))],
+                    tags=street_tags(f"Row {row}", row),
+                    version=1,
+                )
+            )
+            way_id += 1
+        for column in range(len(lons)):
+            writer.add_way(
+                osmium.osm.mutable.Way(
+                    id=way_id,
+                    nodes=[node_id(row, column) for row in range(len(lats))],
+                    tags=street_tags(f"Column {column}", column),
+                    version=1,
+                )
+            )
+            way_id += 1
+    temporary_path.replace(path)
+
+
+def street_tags(name: str, position: int) -> dict:
+    highway = "primary" if position % 5 == 0 else "residential"
+    return {"highway": highway, "name": name}
+
+
+def bus_feed(
+    path: Path,
+    lons: np.ndarray,
+    lats: np.ndarray,
+    routes: int,
+    stop_spacing: int = 2,
+    headway_minutes: int = 10,
+    service_hours: tuple[int, int] = (5, 24),
+) -> None:
+    """
+    Writes a GTFS feed of bus routes running straight along streets of the grid in both directions.
+    param: path: zip file to write
+    param: lons: longitudes of the north-south streets
+    param: lats: latitudes of the east-west streets
+    param: routes: number of routes
+    param: stop_spacing: number of blocks between stops
+    param: headway_minutes: minutes between departures
+    param: service_hours: first and last hour of service
+    """
+    stops = {}
+    route_rows = []
+    trip_rows = []
+    stop_time_rows = []
+    for route in range(routes):
+        # spread the routes over the grid, alternating between both directions
+        lines = len(lats) if route % 2 == 0 else len(lons)
+        line = int((route // 2 + 1) * lines / (routes // 2 + 2)) % lines
+        positions = range(0, len(lons) if route % 2 == 0 else len(lats), stop_spacing)
+        route_stops = []
+        for position in positions:
+            if route % 2 == 0:
+                stop_id = f"r{line}_c{position}"
+                lon, lat = lons[position], lats[line]
+            else:
+                stop_id = f"r{position}_c{line}"
+                lon, lat = lons[line], lats[position]
+            stops[stop_id] = (lon, lat)
+            route_stops.append(stop_id)
+
+        route_id = f"route_{route}"
+        route_rows.append(
+            {"route_id": route_id, "agency_id": "bench", "route_short_name": str(route + 1), "route_type": 3}
+        )
+        for direction, sequence in enumerate((route_stops, route_stops[::-1])):
+            for start in range(service_hours[0] * 60, service_hours[1] * 60, headway_minutes):
+                trip_id = f"{route_id}_{direction}_{start}"
+                trip_rows.append(
+                    {"route_id": route_id, "service_id": "daily", "trip_id": trip_id, "direction_id": direction}
+                )
+                for stop_sequence, stop_id in enumerate(sequence):
+                    clock = gtfs_time(start + stop_sequence * stop_spacing)
+                    stop_time_rows.append(
+                        {
+                            "trip_id": trip_id,
+                            "arrival_time": clock,
+                            "departure_time": clock,
+                            "stop_id": stop_id,
+                            "stop_sequence": stop_sequence,
+                        }
+                    )
+
+    tables = {
+        "agency.txt": pd.DataFrame(
+            [{"agency_id": "bench", "agency_name": "Benchmark", "agency_url": "https://example.org", "agency_timezone": "Europe/Berlin"}]
+        ),
+        "stops.txt": pd.DataFrame(
+            [
+                {"stop_id": stop_id, "stop_name": stop_id, "stop_lat": round(lat, 6), "stop_lon": round(lon, 6)}
+                for stop_id, (lon, lat) in sorted(stops.items())
+            ]
+        ),
+        "routes.txt": pd.DataFrame(route_rows),
+        "trips.txt": pd.DataFrame(trip_rows),
+        "stop_times.txt": pd.DataFrame(stop_time_rows),
+        "calendar.txt": pd.DataFrame(
+            [
+                {
+                    "service_id": "daily",
+                    **{day: 1 for day in ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")},
+                    "start_date": "20250101",
+                    "end_date": "20251231",
+                }
+            ]
+        ),
+    }
+    temporary_path = Path(path).with_suffix(".tmp")
+    with zipfile.ZipFile(temporary_path, "w") as feed:
+        for table, data in tables.items():
+            info = zipfile.ZipInfo(table, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            feed.writestr(info, data.to_csv(index=False))
+    temporary_path.replace(path)
+
+
+def gtfs_time(minutes: int) -> str:
+    """Formats minutes after midnight as a GTFS time, which may exceed 24:00:00"""
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:00"
+
+
+def population_raster(
+    path: Path, bounds: np.ndarray, pixel_metres: float = 100, seed: int = 0
+) -> None:
+    """
+    Writes a population GeoTIFF in EPSG:4326 with a dense centre thinning out towards the edges.
+    param: path: file to write
+    param: bounds: left, bottom, right, top of the covered area
+    param: pixel_metres: approximate size of a pixel
+    param: seed: seed of the noise added to the density
+    """
+    left, bottom, right, top = bounds
+    resolution = pixel_metres / METRES_PER_DEGREE
+    width = max(1, math.ceil((right - left) / resolution))
+    height = max(1, math.ceil((top - bottom) / resolution))
+    y, x = np.mgrid[0:height, 0:width]
+    distance = np.hypot((x - width / 2) / width, (y - height / 2) / height)
+    rng = np.random.default_rng(seed)
+    population = 150 * np.exp(-8 * distance**2) * rng.uniform(0.5, 1.5, size=(height, width))
+    population[rng.random((height, width)) < 0.1] = 0
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:4326",
+        "transform": rio.transform.from_origin(left, top, resolution, resolution),
+        "nodata": -200,
+        "compress": "deflate",
+    }
+    with rio.open(path, "w", **profile) as target:
+        target.write(population.astype(np.float32), 1)
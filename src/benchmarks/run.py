@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import logging as log
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+import r5py
+import shapely
+# registers the .h3 accessor used for hexgrids
+import h3pandas
+import benchmarks.fixtures as fixtures
+import utils.centrality as centrality
+import utils.destination as dst
+import utils.gtfs as gtfs
+import utils.instrumentation as instrumentation
+import utils.osmfile as osm
+import utils.output as output
+import utils.raster as raster
+from main import departure_bins
+
+
+def run_city(
+    city: fixtures.City, departures: list[int], workdir: Path, repeat: int = 3
+) -> dict:
+    """
+    Runs every pipeline stage on a synthetic city with cold caches and times it with instrumentation spans.
+    param: city: City from fixtures.make_city
+    param: departures: numbers of hourly departure times to route, one routing stage each
+    param: workdir: folder for caches and outputs of the runs
+    param: repeat: number of runs, stage times are the median over runs
+    return: dict with cell counts and wall time, CPU time and peak RSS per stage
+    """
+    runs = []
+    for run in range(repeat):
+        log.info(f"Benchmarking {city.name}, run {run + 1} of {repeat}")
+        run_dir = Path(workdir, city.name, f"run_{run}")
+        shutil.rmtree(run_dir, ignore_errors=True)
+        run_dir.mkdir(parents=True)
+        instrumentation.reset()
+        cells = run_stages(city, departures, run_dir)
+        runs.append(stage_totals(instrumentation.report()["spans"]))
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    stages = {}
+    for stage in runs[0]:
+        stages[stage] = {
+            "wall_seconds": round(statistics.median(run[stage]["wall_seconds"] for run in runs), 3),
+            "cpu_seconds": round(statistics.median(run[stage]["cpu_seconds"] for run in runs), 3),
+            "peak_rss_mb": max_or_none(run[stage]["peak_rss_mb"] for run in runs),
+        }
+    return {**cells, "stages": stages}
+
+
+def run_stages(city: fixtures.City, departures: list[int], run_dir: Path) -> dict:
+    """Runs the pipeline stages once, the same way main.analyse_group does"""
+    # main no longer polygonises the raster, it is timed on its own for comparison with older baselines
+    with instrumentation.span("raster_polygons"):
+        raster.gdf_to_data_raster(city.place, city.population_path)
+
+    # main only crops large extracts, the crop is timed on its own against the osmosis crop it replaced
+    crop_area = shapely.affinity.scale(city.place.unary_union, xfact=0.5, yfact=0.5)
+    with instrumentation.span("osm_crop"):
+        osm.crop_pbf(city.osm_path, Path(run_dir, "crop.osm.pbf"), crop_area)
+    if shutil.which("osmosis") is not None:
+        with instrumentation.span("osm_crop_osmosis"):
+            osmosis_crop(city.osm_path, Path(run_dir, "crop_osmosis.osm.pbf"), crop_area.bounds)
+
+    with instrumentation.span("end_to_end", city=city.name):
+        with instrumentation.span("hexgrid") as counts:
+            hexgrid = dst.places_to_pop_hexgrids(
+                place=city.place, pop_data=city.population_path, cache_dir=run_dir
+            )
+            populated = dst.prune_unpopulated(hexgrid)
+            counts["cells"] = len(populated)
+
+        with instrumentation.span("gtfs_crop"):
+            feed = gtfs.GTFS(city.gtfs_path).crop_gtfs(
+                city.place, name=city.name, cache_dir=run_dir
+            )
+
+        with instrumentation.span("network"):
+            transport_network = r5py.TransportNetwork(
+                osm_pbf=str(city.osm_path), gtfs=str(feed.path)
+            )
+
+        origins = dst.centroids(populated)
+        for count in departures:
+            times = departure_bins(start=7 * 60, end=(7 + count) * 60, minutes=60)
+            destinations = dst.destination_sets_from_dataframe(data=populated, times=times)
+            with instrumentation.span(f"closeness_{count}_departures", departures=count):
+                results = [
+                    centrality.closeness_metrics(transport_network, origins, destination)
+                    for destination in destinations
+                ]
+
+        writer = output.ResultWriter(
+            name=city.name, hexgrid=hexgrid, directory=Path(run_dir, "output")
+        )
+        for result in results:
+            writer.add(result)
+        writer.finish()
+
+    return {"cells": len(hexgrid), "populated_cells": len(populated)}
+
+
+def osmosis_crop(source: Path, target: Path, bounds: tuple) -> None:
+    """Crops an osm.pbf file to a bounding box with osmosis, the way OSMFile.crop did before crop_pbf"""
+    left, bottom, right, top = bounds
+    subprocess.run(
+        [
+            "osmosis",
+            "--read-pbf",
+            f"file={source}",
+            "--bounding-box",
+            f"top={top}",
+            f"left={left}",
+            f"bottom={bottom}",
+            f"right={right}",
+            "completeWays=yes",
+            "--write-pbf",
+            f"file={target}",
+        ],
+        check=True,
+    )
+
+
+def stage_totals(spans: list[dict]) -> dict:
+    """Adds up the spans of a run by name, e.g. every routing call"""
+    totals = {}
+    for span in spans:
+        total = totals.setdefault(
+            span["name"], {"wall_seconds": 0, "cpu_seconds": 0, "peak_rss_mb": None}
+        )
+        total["wall_seconds"] += span["wall_seconds"]
+        total["cpu_seconds"] += span["cpu_seconds"]
+        total["peak_rss_mb"] = max_or_none([total["peak_rss_mb"], span["peak_rss_mb"]])
+    return totals
+
+
+def max_or_none(values) -> float | None:
+    """Returns the largest value that isn't None, peak RSS is None where it can't be measured per span"""
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2, minimum: float = 0.05) -> list[str]:
+    """
+    Compares stage wall times against a baseline.
+    param: results: benchmark results from run_city per city
+    param: baseline: earlier benchmark results in the same format
+    param: tolerance: relative slowdown above which a stage counts as a regression
+    param: minimum: stages faster than this many seconds in the baseline are ignored as noise
+    return: list of regression messages
+    """
+    regressions = []
+    for name, city in results["cities"].items():
+        baseline_city = baseline.get("cities", {}).get(name)
+        if baseline_city is None:
+            continue
+        for stage, timings in city["stages"].items():
+            reference = baseline_city["stages"].get(stage)
+            if reference is None or reference["wall_seconds"] < minimum:
+                continue
+            ratio = timings["wall_seconds"] / reference["wall_seconds"]
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{name} {stage}: {timings['wall_seconds']:.2f}s vs {reference['wall_seconds']:.2f}s ({ratio:.2f}x)"
+                )
+    return regressions
+
+
+def print_curves(results: dict, baseline: dict = None) -> None:
+    """Prints wall times per stage across city sizes, with the ratio to the baseline in brackets"""
+    cities = results["cities"]
+    stages = sorted({stage for city in cities.values() for stage in city["stages"]})
+    header = "stage".ljust(32) + "".join(
+        f"{name} ({city['populated_cells']} cells)".rjust(30) for name, city in cities.items()
+    )
+    print(header)
+    for stage in stages:
+        row = stage.ljust(32)
+        for name, city in cities.items():
+            timings = city["stages"].get(stage)
+            if timings is None:
+                row += "-".rjust(30)
+                continue
+            cell = f"{timings['wall_seconds']:.2f}s"
+            reference = (baseline or {}).get("cities", {}).get(name, {}).get("stages", {}).get(stage)
+            if reference and reference["wall_seconds"] > 0:
+                cell += f" ({timings['wall_seconds'] / reference['wall_seconds']:.2f}x)"
+            row += cell.rjust(30)
+        print(row)
+
+
+def environment() -> dict:
+    """Describes the machine and versions the benchmarks ran with"""
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "r5py": r5py.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def cli_input():
+    parser = argparse.ArgumentParser(
+        description="benchmarks of the pipeline stages on synthetic cities"
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=list(fixtures.SIZES),
+        default=["small", "medium"],
+        help="city sizes to benchmark, see fixtures.SIZES",
+    )
+    parser.add_argument(
+        "--departures",
+        nargs="+",
+        type=int,
+        default=[1, 2, 4],
+        help="numbers of hourly departure times to route, for scaling by departure count",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per city, times are medians")
+    parser.add_argument(
+        "--workdir",
+        default="/data/benchmarks",
+        help="directory for fixtures, caches and outputs of the runs",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="baseline results to compare against, defaults to baseline.json in the workdir",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store these results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown of a stage reported as a regression",
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with status 1 if any stage regressed",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    log.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=log.DEBUG if args.verbose else log.INFO,
+    )
+    if args.baseline is None:
+        args.baseline = Path(args.workdir, "baseline.json")
+    return args
+
+
+if __name__ == "__main__":
+    args = cli_input()
+    workdir = Path(args.workdir)
+    cities = fixtures.make_cities(Path(workdir, "fixtures"), args.sizes)
+
+    results = {**environment(), "departures": args.departures, "repeat": args.repeat, "cities": {}}
+    for city in cities:
+        results["cities"][city.name] = run_city(city, args.departures, workdir, repeat=args.repeat)
+
+    results_path = Path(workdir, f"results_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    results_path.write_text(json.dumps(results, indent=2))
+    log.info(f"Saved benchmark results to {results_path}")
+
+    baseline = None
+    if Path(args.baseline).exists():
+        baseline = json.loads(Path(args.baseline).read_text())
+    print_curves(results, baseline)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            log.warning(f"Regression in {regression}")
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2))
+        log.info(f"Saved baseline to {args.baseline}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
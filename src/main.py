@@ -9,91 +9,448 @@ import utils.gtfs as gtfs
 import utils.osmfile as osm
 import utils.centrality as centrality
 import utils.centrality as centrality
+import utils.scheduler as scheduler
+import utils.network as network
+import utils.cache as cache
+import utils.geocache as geocache
+import utils.output as output
+import utils.checkpoint as checkpoint
+import utils.matrix as matrix
+import utils.instrumentation as instrumentation
 import datetime
+import functools
 from enum import Enum
+from pathlib import Path
 
 # TODO adapt this for temporal analysis, or make yet anouther script...
 
-def main(place_name: str, gtfs_path: str):
+def main(
+    place_names: list[str],
+    gtfs_path: str,
+    workers: int = 1,
+    cache_dir: str = cache.CACHE_DIR,
+    pop_data: str = "/data/population",
+    min_population: float = 0,
+    boundaries: str = None,
+    geojson: bool = False,
+    chunk_size: int = None,
+    adaptive: tuple[int, int] = None,
+    refine_population: float = 1000,
+    refine_gradient: float = 5,
+    sample: int = None,
+    departures: tuple[int, int, int] = (0, 24 * 60, 60),
+    keep_matrices: bool = False,
+    report: str = None,
+):
     log.debug(msg="testing")
+    if report is None:
+        report = Path("/data/output", f"report_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+
+    # the report is written for failed runs too, those are the ones needed to size containers
+    completed = False
+    try:
+        geocode_cache = geocache.GeocodeCache(path=Path(cache_dir, "geocode.sqlite"))
+        if boundaries is not None:
+            source = cache.file_digest(boundaries, cache_dir=cache_dir)
+            if geocode_cache.preloaded(source):
+                log.info(f"Boundaries of {boundaries} are already in the geocode cache")
+            else:
+                geocode_cache.preload(dst.boundaries_from_file(boundaries), source=source)
+
+        places = {}
+        for place_name in place_names:
+            with instrumentation.span("geocoding", place=place_name):
+                place = dst.geocoding(place_name, geocode_cache=geocode_cache)
+            buffer = 100
+            buffered_place = dst.buffer(data = place, buffer = buffer)
+            places[place_name] = (place, buffered_place)
+
+        for group_name, group in group_places(places).items():
+            analyse_group(
+                group_name=group_name,
+                places={place_name: places[place_name] for place_name in group},
+                gtfs_path=gtfs_path,
+                workers=workers,
+                cache_dir=cache_dir,
+                pop_data=pop_data,
+                min_population=min_population,
+                geojson=geojson,
+                chunk_size=chunk_size,
+                adaptive=adaptive,
+                refine_population=refine_population,
+                refine_gradient=refine_gradient,
+                sample=sample,
+                departures=departures,
+                keep_matrices=keep_matrices,
+            )
+        completed = True
+    finally:
+        try:
+            instrumentation.save_report(
+                report,
+                completed=completed,
+                places=place_names,
+                gtfs=gtfs_path,
+                workers=scheduler.worker_count(workers),
+                chunk_size=chunk_size,
+                adaptive=adaptive,
+                sample=sample,
+                departures=departures,
+            )
+        except OSError as error:
+            log.error(f"Could not save run report to {report}: {error}")
+
+
+def group_places(places: dict) -> dict[str, list[str]]:
+    """
+    Groups places by the smallest Geofabrik region covering them.
+    Places in a group share OSM data and one transport network.
+    param: places: dict of place names and tuples of place and buffered place GeoDataFrames
+    return: dict of region ids and lists of place names
+    """
+    groups = {}
+    for place_name, (_, buffered_place) in places.items():
+        region, _ = osm.find_online_data(gdf=buffered_place)
+        groups.setdefault(region, []).append(place_name)
+    log.info(f"Grouped {len(places)} places into {len(groups)} transport networks")
+    return groups
 
-    place = dst.geocoding(place_name)
-    buffer = 100
-    buffered_place = dst.buffer(data = place, buffer = buffer)
+
+def analyse_group(
+    group_name: str,
+    places: dict,
+    gtfs_path: str,
+    workers: int = 1,
+    cache_dir: str = cache.CACHE_DIR,
+    pop_data: str = "/data/population",
+    min_population: float = 0,
+    geojson: bool = False,
+    chunk_size: int = None,
+    adaptive: tuple[int, int] = None,
+    refine_population: float = 1000,
+    refine_gradient: float = 5,
+    sample: int = None,
+    departures: tuple[int, int, int] = (0, 24 * 60, 60),
+    keep_matrices: bool = False,
+):
+    """
+    Builds one transport network for a group of places and routes all of them in one scheduled pass.
+    param: group_name: name of the group, e.g. its Geofabrik region
+    param: places: dict of place names and tuples of place and buffered place GeoDataFrames
+    param: sample: (Optional) route to a sample of about this many destination cells and add confidence intervals
+    param: departures: (Optional) start, end and bin length in minutes of the routed departure times, see departure_bins
+    param: keep_matrices: (Optional) if True the travel time matrices are stored next to the output for metrics_from_matrix
+    """
+    if len(places) == 1:
+        [network_name] = places
+    else:
+        network_name = f"{group_name}_batch"
+    buffered_places = gpd.GeoDataFrame(
+        geometry=[
+            pd.concat([buffered_place for _, buffered_place in places.values()]).unary_union
+        ],
+        crs="EPSG:4326",
+    )
 
     transit_feed = gtfs.GTFS(path=gtfs_path)
-    # Check if gtfs file actually covers the extent of the place
-    if not transit_feed.covers_location(other=place):
-        log.warning(
-            f"specified gtfs feed at {transit_feed.path} doesn't have stop locations in specified area. Calculations for WALKING only."
+    # Check if gtfs file actually covers the extent of the places
+    covered = False
+    with instrumentation.span("gtfs_coverage", places=len(places)):
+        for place_name, (place, _) in places.items():
+            if transit_feed.covers_location(other=place, cache_dir=cache_dir):
+                covered = True
+            else:
+                log.warning(
+                    f"specified gtfs feed at {transit_feed.path} doesn't have stop locations in {place_name}. Calculations for WALKING only."
+                )
+    # without any stops in the area the feed is kept whole, a crop would have no service dates
+    if covered:
+        with instrumentation.span("gtfs_crop", network=network_name):
+            transit_feed.crop_gtfs(
+                buffered_places,
+                name=f"{transit_feed.name}_{network_name}",
+                inplace=True,
+                cache_dir=cache_dir,
+            )
+
+    with instrumentation.span("osm_data", network=network_name):
+        matching_osm_file = osm.get_osm_data(
+            geodata=buffered_places, name=network_name, cache_dir=cache_dir
         )
-    try:
-        transit_feed.crop_gtfs(buffered_place, inplace=True)
-    except NotImplementedError:
-        pass
 
-    matching_osm_file = osm.get_osm_data(geodata=buffered_place, name=place_name)
-    # TODO crop osm data to buffered place anyhow?
+    log.info(f"creating transport network for {network_name}")
+    network_cache = network.NetworkCache(cache_dir=cache_dir)
+    with instrumentation.span("network", network=network_name):
+        transport_network = network_cache.load_network(
+            osm_path=matching_osm_file.path, gtfs_path=transit_feed.path
+        )
+    log.info(f"created transport network for {network_name}")
+    network_key = network_cache.key(
+        osm_path=matching_osm_file.path, gtfs_path=transit_feed.path
+    )
 
-    hexgrid = dst.places_to_pop_hexgrids(place=buffered_place, pop_data='/data/population/GHS_POP_E2030_GLOBE_R2023A_4326_3ss_V1_0_R4_C19.tif')
-    # TODO exclude non populated areas
+    start, end, minutes = departures
+    times = departure_bins(start, end, minutes)
+    window = datetime.timedelta(minutes=minutes)
 
-    log.info(f"creating transport network for {place_name}")
-    transport_network = r5py.TransportNetwork(
-        osm_pbf=matching_osm_file.path, gtfs=transit_feed.path
-    )
-    log.info(f"created transport network for {place_name}")
-    
-    #creating enum with every time of day
-    time = datetime.time(hour=0)
-    hour_step = 0
-    times_of_day = []
-    while hour_step < 24:
-        time = time.replace(hour=hour_step)
-        times_of_day.append((str(time.hour),time))
-        hour_step += 1
-    times = Enum("Times", times_of_day)
-
-    # Processing destination data for every time of day
-    # TODO exclude cells with 0 population from destinations
-    destinations = dst.destination_sets_from_dataframe(data=hexgrid, times=times)
-
-    # Computing and matching up results
-    results = hexgrid
-    for destination in destinations:
-        result = centrality.median_closeness(
-            transit=transport_network,
-            hexgrid=dst.centroids(hexgrid),
-            destination=destination,
+    # Processing hexgrids and destination data for every place and time of day
+    tasks = []
+    jobs = []
+    for place_name, (_, buffered_place) in places.items():
+        with instrumentation.span("hexgrid", place=place_name) as counts:
+            if adaptive is None:
+                hexgrid = dst.places_to_pop_hexgrids(
+                    place=buffered_place, pop_data=pop_data, cache_dir=cache_dir
+                )
+            else:
+                coarse_resolution, fine_resolution = adaptive
+                hexgrid = centrality.adaptive_hexgrid(
+                    transit=transport_network,
+                    place=buffered_place,
+                    pop_data=pop_data,
+                    coarse_resolution=coarse_resolution,
+                    fine_resolution=fine_resolution,
+                    population_threshold=refine_population,
+                    gradient_threshold=refine_gradient,
+                    min_population=min_population,
+                    cache_dir=cache_dir,
+                )
+            # unpopulated cells are neither origins nor destinations, they stay empty in the output
+            populated = dst.prune_unpopulated(hexgrid, threshold=min_population)
+            counts["cells"] = len(hexgrid)
+            counts["populated_cells"] = len(populated)
+        if populated.empty:
+            log.warning(
+                f"No populated cells in {place_name}, the population data doesn't seem to cover it. Skipping {place_name}."
+            )
+            continue
+        if sample is None:
+            destination_cells = populated
+        else:
+            destination_cells = dst.sample_hexgrid(populated, size=sample)
+        destinations = dst.destination_sets_from_dataframe(
+            data=destination_cells, times=times, window=window
         )
-        results = results.join(other=result, on="id")
-        # TODO add difference
-    
-    results.to_file(f"/data/output/{place_name}.json")
-
-    results = hexgrid
-    for destination in destinations:
-        result = centrality.percentile_difference(
-            transit=transport_network,
-            hexgrid=dst.centroids(hexgrid),
-            destination=destination,
+        origins = dst.centroids(populated)
+        checkpoints = checkpoint.Checkpoints(
+            fingerprint=checkpoint.fingerprint(
+                network_key, populated, centrality.PERCENTILES, sample, minutes
+            ),
+            cache_dir=cache_dir,
+        )
+        medians = output.ResultWriter(name=place_name, hexgrid=hexgrid, geojson=geojson)
+        differences = output.ResultWriter(
+            name=f"{place_name}_difference", hexgrid=hexgrid, geojson=geojson
+        )
+        matrix_store = None
+        if keep_matrices:
+            matrix_store = matrix.MatrixStore(path=Path(medians.directory, f"{place_name}.matrices"))
+        for destination in destinations:
+            tasks.append(
+                (
+                    f"{place_name} {destination.name}",
+                    functools.partial(
+                        closeness_task,
+                        transport_network,
+                        origins,
+                        destination,
+                        checkpoints,
+                        medians,
+                        differences,
+                        chunk_size,
+                        matrix_store,
+                    ),
+                )
+            )
+        jobs.append((destinations, checkpoints, medians, differences))
+
+    # Computing results from one travel time matrix per place and departure time
+    with instrumentation.span("scheduled_routing", network=network_name, tasks=len(tasks)):
+        scheduler.run_tasks(tasks=tasks, workers=workers)
+
+    for destinations, checkpoints, medians, differences in jobs:
+        medians.finish(
+            columns=[
+                column
+                for destination in destinations
+                for column in metric_columns("median", destination)
+            ]
+        )
+        differences.finish(
+            columns=[
+                column
+                for destination in destinations
+                for column in metric_columns("difference", destination)
+            ]
+        )
+        checkpoints.clear()
+
+
+def closeness_task(
+    transport_network: r5py.TransportNetwork,
+    origins: gpd.GeoDataFrame,
+    destination: dst.DestinationSet,
+    checkpoints: checkpoint.Checkpoints,
+    medians: output.ResultWriter,
+    differences: output.ResultWriter,
+    chunk_size: int = None,
+    matrix_store: matrix.MatrixStore = None,
+) -> pd.DataFrame:
+    """
+    Computes centrality metrics for one DestinationSet and saves them as soon as they finish.
+    DestinationSets finished by an earlier, interrupted run are read from their checkpoint.
+    """
+    result = checkpoints.load(destination)
+    if result is None:
+        result = centrality.closeness_metrics(
+            transport_network,
+            origins,
+            destination,
+            chunk_size=chunk_size,
+            matrix_store=matrix_store,
         )
-        results = results.join(other=result, on="id")
+        checkpoints.save(destination, result)
+    medians.add(result[metric_columns("median", destination)])
+    differences.add(result[metric_columns("difference", destination)])
+    return result
 
-    results.to_file(f"/data/output/{place_name}_difference.json")
-    
+
+def metric_columns(metric: str, destination: dst.DestinationSet) -> list[str]:
+    """Returns the result columns of a metric, with its confidence interval for sampled destinations"""
+    columns = [f"{metric}_{destination.name}"]
+    if "inclusion" in destination.destinations.columns:
+        columns.append(f"{metric}_{destination.name}_ci")
+    return columns
+
+
+def departure_bins(start: int = 0, end: int = 24 * 60, minutes: int = 60) -> Enum:
+    """
+    Returns an Enum of departure times splitting a part of the day into bins of equal length.
+    Each bin is routed with a departure window as long as the bin, so the bins tile the day without gaps.
+    param: start: first departure in minutes after midnight
+    param: end: bins start before this many minutes after midnight, at most 24 * 60
+    param: minutes: length of each bin and its departure window
+    return: Enum named by hour, or hour_minute for bins not starting on the hour
+    """
+    times_of_day = []
+    for minute in range(start, end, minutes):
+        time = datetime.time(hour=minute // 60, minute=minute % 60)
+        name = str(time.hour) if time.minute == 0 else f"{time.hour}_{time.minute:02d}"
+        times_of_day.append((name, time))
+    return Enum("Times", times_of_day)
+
+
+def minute_of_day(clock: str) -> int:
+    """Parses a HH:MM time, 24:00 included, into minutes after midnight"""
+    hour, minute = clock.split(":")
+    minutes = int(hour) * 60 + int(minute)
+    if not 0 <= minutes <= 24 * 60:
+        raise argparse.ArgumentTypeError(f"{clock} is not a time of day")
+    return minutes
 
 
 def cli_input():
     parser = argparse.ArgumentParser(
-        description="all closeness centrality calculations for one county"
+        description="all closeness centrality calculations for one or more places"
+    )
+    parser.add_argument("places", nargs="*", help="specify place(s)")
+    parser.add_argument(
+        "--places-file",
+        help="specify a text file with one place per line, analysed in addition to places",
     )
-    parser.add_argument("place", help="specify place")
     parser.add_argument("-g", "--gtfs", help="specify gtfs file")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of departure times routed in parallel, 0 uses every core",
+    )
+    parser.add_argument(
+        "-p",
+        "--population",
+        default="/data/population",
+        help="specify population raster, VRT mosaic or directory of raster tiles",
+    )
+    parser.add_argument(
+        "--min-population",
+        type=float,
+        default=0,
+        help="cells with a population at or below this are excluded from routing, -1 keeps every cell",
+    )
+    parser.add_argument(
+        "--boundaries",
+        help="specify an osm.pbf or vector file with named boundaries to preload into the geocode cache",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=cache.CACHE_DIR,
+        help="directory for cached transport networks and intermediate data",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="number of origins routed at once, bounds memory for large hexgrids",
+    )
+    parser.add_argument(
+        "--adaptive",
+        type=int,
+        nargs=2,
+        metavar=("COARSE", "FINE"),
+        help="route a coarse h3 resolution first and refine dense or steep cells to the fine resolution",
+    )
+    parser.add_argument(
+        "--refine-population",
+        type=float,
+        default=1000,
+        help="with --adaptive, coarse cells with at least this population are refined",
+    )
+    parser.add_argument(
+        "--refine-gradient",
+        type=float,
+        default=5,
+        help="with --adaptive, coarse cells differing from a neighbour by more minutes are refined",
+    )
+    parser.add_argument(
+        "--departures",
+        nargs=3,
+        metavar=("START", "END", "MINUTES"),
+        default=["00:00", "24:00", "60"],
+        help="route departures from START to END (HH:MM) in bins of MINUTES, each with a window of MINUTES",
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        help="route to a population weighted sample of about this many destination cells and add 95%% confidence intervals",
+    )
+    parser.add_argument(
+        "--keep-matrices",
+        action="store_true",
+        help="store the travel time matrices next to the output, so metrics can be recomputed without routing",
+    )
+    parser.add_argument(
+        "--report",
+        help="path of the JSON run report with timings and memory per stage, defaults to a timestamped file in /data/output",
+    )
+    parser.add_argument(
+        "--geojson",
+        action="store_true",
+        help="also write results as GeoJSON next to the GeoParquet output",
+    )
     parser.add_argument("--verbose", action="store_true")
     args = parser.parse_args()
-    place_name = args.place
-    config_path = args.gtfs
+    if args.places_file is not None:
+        with open(args.places_file) as places_file:
+            args.places += [line.strip() for line in places_file if line.strip()]
+    if not args.places:
+        parser.error("specify at least one place or a places file")
+    start, end, minutes = args.departures
+    try:
+        args.departures = (minute_of_day(start), minute_of_day(end), int(minutes))
+    except (ValueError, argparse.ArgumentTypeError):
+        parser.error("--departures takes two HH:MM times of day and a number of minutes")
+    if args.departures[2] <= 0 or args.departures[0] >= args.departures[1]:
+        parser.error("--departures needs START before END and a positive number of MINUTES")
     verbosity = args.verbose
     if verbosity:
         log.basicConfig(
@@ -104,9 +461,26 @@ def cli_input():
             format="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=log.INFO
         )
 
-    return place_name, config_path
+    return args
 
 
 if __name__ == "__main__":
-    place_name, gtfs_path = cli_input()
-    main(place_name, gtfs_path)
+    args = cli_input()
+    main(
+        place_names=args.places,
+        gtfs_path=args.gtfs,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        pop_data=args.population,
+        min_population=args.min_population,
+        boundaries=args.boundaries,
+        geojson=args.geojson,
+        chunk_size=args.chunk_size,
+        adaptive=args.adaptive,
+        refine_population=args.refine_population,
+        refine_gradient=args.refine_gradient,
+        sample=args.sample,
+        departures=args.departures,
+        keep_matrices=args.keep_matrices,
+        report=args.report,
+    )
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging as log
+import os
+from pathlib import Path
+
+# default location for persistent caches, inside the mounted data folder to survive container runs
+CACHE_DIR = Path("/data/cache")
+
+
+def file_digest(path: Path, cache_dir: Path = CACHE_DIR) -> str:
+    """
+    Returns a content hash of a file or of all files in a directory.
+    Hashes are memoised by path, size and modification time so large inputs are only read once.
+    For directories these are the number and total size of the files and the latest modification
+    of any file or folder in it, so changing a file inside invalidates the hash.
+    param: path: file or directory to hash
+    param: cache_dir: directory holding the digest memo
+    return: hex digest
+    """
+    path = Path(path).absolute()
+    files = sorted(path.rglob("*")) if path.is_dir() else [path]
+    stats = {entry: entry.stat() for entry in [path, *files]}
+    sizes = [stats[file].st_size for file in files if file.is_file()]
+    latest = max(stat.st_mtime_ns for stat in stats.values())
+    memo_key = f"{path}:{len(sizes)}:{sum(sizes)}:{latest}"
+    memo_path = Path(cache_dir, "digests.json")
+    try:
+        memo = json.loads(memo_path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        memo = {}
+    if memo_key in memo:
+        return memo[memo_key]
+
+    log.info(f"Hashing {path}")
+    digest = hashlib.blake2b(digest_size=16)
+    for file in files:
+        if not file.is_file():
+            continue
+        digest.update(str(file.relative_to(path.parent)).encode())
+        with open(file, "rb") as content:
+            while chunk := content.read(2**24):
+                digest.update(chunk)
+
+    memo[memo_key] = digest.hexdigest()
+    memo_path.parent.mkdir(parents=True, exist_ok=True)
+    memo_path.write_text(json.dumps(memo))
+    return memo[memo_key]
+
+
+def touch(path: Path) -> None:
+    """Marks a cache entry as recently used"""
+    os.utime(path)
+
+
+def evict_lru(directory: Path, budget: int, pattern: str = "*", keep: list = []) -> list[Path]:
+    """
+    Deletes least recently used files in a cache directory until it fits a size budget.
+    param: directory: cache directory
+    param: budget: maximum total size in bytes
+    param: pattern: glob pattern of cache entries
+    param: keep: paths that must not be evicted, e.g. entries currently in use
+    return: list of evicted paths
+    """
+    keep = {Path(path).absolute() for path in keep}
+    entries = sorted(
+        (entry for entry in Path(directory).glob(pattern) if entry.is_file()),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    total = sum(entry.stat().st_size for entry in entries)
+    evicted = []
+    for entry in entries:
+        if total <= budget:
+            break
+        if entry.absolute() in keep:
+            continue
+        total -= entry.stat().st_size
+        entry.unlink()
+        evicted.append(entry)
+        log.info(f"Evicted {entry} from cache")
+    return evicted
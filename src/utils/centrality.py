@@ -1,83 +1,414 @@
 import datetime
 import logging as log
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import r5py
 import utils.destination as dst
+import utils.cache as cache
+import utils.matrix as matrix
+import utils.instrumentation as instrumentation
 
+# percentiles needed for all metrics, computed in a single routing run
+PERCENTILES = [10, 50, 90]
 
-def median_closeness(
+
+def adaptive_hexgrid(
     transit: r5py.TransportNetwork,
-    hexgrid: gpd.GeoDataFrame,
-    destination=dst.DestinationSet,
+    place: gpd.GeoDataFrame,
+    pop_data: str,
+    coarse_resolution: int = 8,
+    fine_resolution: int = 9,
+    population_threshold: float = 1000,
+    gradient_threshold: float = 5,
+    min_population: float = 0,
+    departure: datetime.time = dst.TimeEnum.NOON.value,
+    cache_dir: str = cache.CACHE_DIR,
 ) -> gpd.GeoDataFrame:
+    """
+    Builds a mixed resolution hexgrid by routing a coarse grid once and refining
+    cells with high population or steep travel time gradients to their neighbours.
+    param: transit: r5py.TransportNetwork to route on
+    param: place: GeoDataFrame with the area to cover
+    param: pop_data: path to the population raster or a directory of raster tiles
+    param: coarse_resolution: h3 resolution routed first
+    param: fine_resolution: h3 resolution of refined cells
+    param: population_threshold: coarse cells with at least this population are refined
+    param: gradient_threshold: coarse cells differing from a neighbour by more minutes are refined
+    param: min_population: cells at or below this population are not routed
+    param: departure: departure time of the coarse probe run
+    param: cache_dir: (Optional) directory for cached raster windows
+    return: gpd.GeoDataFrame with id, population, weight and geometry columns
+    """
+    # the coarse cells are the parents of the fine grid, so both cover the same area
+    fine = dst.places_to_pop_hexgrids(
+        place, pop_data, cache_dir=cache_dir, resolution=fine_resolution
+    )
+    coarse = dst.coarsen_hexgrid(fine, resolution=coarse_resolution)
+    populated = dst.prune_unpopulated(coarse, threshold=min_population)
+    if populated.empty:
+        log.warning("No populated cells to route a probe on, the grid is not refined")
+        return coarse
+    probe = dst.DestinationSet(
+        name="probe", destinations=dst.centroids(populated), departure_time=departure
+    )
+    log.info(msg=f"Routing probe on {len(populated)} cells at resolution {coarse_resolution}")
+    metrics = closeness_metrics(transit, dst.centroids(populated), probe)
+
+    cells = dst.refinement_candidates(
+        coarse,
+        metric=metrics["median_probe"],
+        population_threshold=population_threshold,
+        gradient_threshold=gradient_threshold,
+    )
+    return dst.refine_hexgrid(coarse, fine, cells)
+
+
+def travel_time_matrix(
+    transit: r5py.TransportNetwork,
+    hexgrid: gpd.GeoDataFrame,
+    destination: dst.DestinationSet,
+    percentiles: list[int] = PERCENTILES,
+) -> pd.DataFrame:
+    """
+    Computes one travel time matrix for a DestinationSet with all requested percentiles.
+    R5 routes every minute of the DestinationSet's departure window and reports percentiles over them.
+    param: transit: r5py.TransportNetwork to route on
+    param: hexgrid: GeoDataFrame with origin centroids
+    param: destination: DestinationSet with destinations and departure time
+    param: percentiles: list of travel time percentiles to compute
+    return: long form travel times with one column per percentile
+    """
     log.info(msg=f"Instantiating TravelTimeMatrixComputer for {destination.name}")
     travel_time_matrix_computer = r5py.TravelTimeMatrixComputer(
         transport_network=transit,
         origins=hexgrid,
         destinations=destination.destinations,
         departure=departure_time(transit, destination),
-        departure_time_window=datetime.timedelta(minutes=60),
+        departure_time_window=destination.window,
         transport_modes=[r5py.TransportMode.WALK, r5py.TransportMode.TRANSIT],
+        percentiles=percentiles,
     )
     log.info(
         msg=f"Computing Travel Time Matrix for {destination.name}. This might take a while ..."
     )
-    travel_times = travel_time_matrix_computer.compute_travel_times()
+    with instrumentation.span(
+        "routing",
+        destination=destination.name,
+        origins=len(hexgrid),
+        destinations=len(destination.destinations),
+    ) as counts:
+        travel_times = travel_time_matrix_computer.compute_travel_times()
+        counts["rows"] = len(travel_times)
     log.info(msg="Finished calculating travel times")
+    return travel_times
 
-    if destination.reversed:
-        travel_time_pivot = travel_times.pivot(
-            index="to_id", columns="from_id", values="travel_time"
-        )
-    else:
-        travel_time_pivot = travel_times.pivot(
-            index="from_id", columns="to_id", values="travel_time"
+
+def closeness_metrics(
+    transit: r5py.TransportNetwork,
+    hexgrid: gpd.GeoDataFrame,
+    destination: dst.DestinationSet,
+    chunk_size: int = None,
+    matrix_store: matrix.MatrixStore = None,
+) -> pd.DataFrame:
+    """
+    Computes all centrality metrics for a DestinationSet from a single travel time matrix.
+    With a chunk_size the origins are routed in blocks, each reduced to per cell sums right away,
+    so at most chunk_size x destinations travel times are held in memory at once.
+    If the destinations are a sample, e.g. from destination.sample_hexgrid, the half width
+    of a 95% confidence interval is added for every metric as a column with a "_ci" suffix.
+    param: transit: r5py.TransportNetwork to route on
+    param: hexgrid: GeoDataFrame with origin centroids
+    param: destination: DestinationSet with destinations and departure time
+    param: chunk_size: (Optional) number of origins routed at once, defaults to all origins
+    param: matrix_store: (Optional) MatrixStore keeping the travel times for metrics_from_matrix
+    return: DataFrame with median and difference columns indexed by cell id
+    """
+    if matrix_store is not None:
+        matrix_store.create(destination, hexgrid["id"], PERCENTILES)
+    sampled = "inclusion" in destination.destinations.columns
+    if chunk_size is None:
+        chunk_size = max(1, len(hexgrid))
+
+    medians = []
+    differences = []
+    for start in range(0, len(hexgrid), chunk_size):
+        if chunk_size < len(hexgrid):
+            log.info(
+                msg=f"Routing origins {start} to {min(start + chunk_size, len(hexgrid))} of {len(hexgrid)}"
+            )
+        travel_times = travel_time_matrix(
+            transit, hexgrid.iloc[start : start + chunk_size], destination
         )
-    
-    result = travel_time_pivot
-    result[f"median_{destination.name}"] = travel_time_pivot.mean(axis=1)
-    result = result[[f"median_{destination.name}"]]
+        medians.append(median_aggregates(travel_times, destination))
+        differences.append(difference_aggregates(travel_times, destination))
+        if matrix_store is not None:
+            matrix_store.write(destination, travel_times)
+        del travel_times
+
+    return metrics_from_aggregates(destination, medians, differences, sampled)
+
+
+def metrics_from_matrix(
+    matrix_store: matrix.MatrixStore, destination: dst.DestinationSet
+) -> pd.DataFrame:
+    """
+    Recomputes the centrality metrics of a DestinationSet from its stored travel time matrix, without routing.
+    The matrix is read chunk by chunk and reduced with the same weights as closeness_metrics.
+    param: matrix_store: MatrixStore the DestinationSet was routed into
+    param: destination: DestinationSet with the destinations used for routing
+    return: DataFrame with median and difference columns indexed by cell id
+    """
+    origins, destination_ids, percentiles = matrix_store.index(destination)
+    sampled = "inclusion" in destination.destinations.columns
+    # the axis averaged over, the other one holds the cells the metrics are reported for
+    axis = 0 if destination.reversed else 1
+    other_ids = origins if destination.reversed else destination_ids
+    cells = destination.destinations.assign(id=destination.destinations["id"].astype(str)).set_index("id")
+
+    weights = None
+    if "weight" in cells.columns:
+        weights = cells["weight"].reindex(other_ids).fillna(1).to_numpy(dtype="float64")
+    variances = None
+    if sampled:
+        inclusion = cells["inclusion"].reindex(other_ids).fillna(1).to_numpy(dtype="float64")
+        variances = (1 - inclusion) * weights**2
+
+    medians = []
+    differences = []
+    for block_origins, minutes in matrix_store.blocks(destination):
+        if destination.reversed:
+            keys = destination_ids
+            block_weights = None if weights is None else weights[origins.get_indexer(block_origins)]
+            block_variances = None if variances is None else variances[origins.get_indexer(block_origins)]
+        else:
+            keys = block_origins
+            block_weights = weights
+            block_variances = variances
+        median = minutes[percentiles.index(50)]
+        difference = minutes[percentiles.index(90)] - minutes[percentiles.index(10)]
+        medians.append(dense_aggregates(keys, median, axis, block_weights, block_variances))
+        differences.append(dense_aggregates(keys, difference, axis, block_weights, block_variances))
+
+    return metrics_from_aggregates(destination, medians, differences, sampled)
+
+
+def metrics_from_aggregates(
+    destination: dst.DestinationSet,
+    medians: list[pd.DataFrame],
+    differences: list[pd.DataFrame],
+    sampled: bool = False,
+) -> pd.DataFrame:
+    """Combines per chunk aggregates into the median and difference columns of a DestinationSet"""
+    columns = {}
+    for metric, aggregates in (("median", medians), ("difference", differences)):
+        aggregates = combine_aggregates(aggregates)
+        columns[f"{metric}_{destination.name}"] = mean_from_aggregates(aggregates)
+        if sampled:
+            columns[f"{metric}_{destination.name}_ci"] = interval_from_aggregates(aggregates)
+    return pd.DataFrame(columns)
+
+
+def median_closeness(
+    transit: r5py.TransportNetwork,
+    hexgrid: gpd.GeoDataFrame,
+    destination=dst.DestinationSet,
+    travel_times: pd.DataFrame = None,
+) -> pd.DataFrame:
+    if travel_times is None:
+        travel_times = travel_time_matrix(transit, hexgrid, destination, percentiles=[50])
+
+    aggregates = median_aggregates(travel_times, destination)
+    result = mean_from_aggregates(aggregates).to_frame(name=f"median_{destination.name}")
     return result
 
 def percentile_difference(
         transit: r5py.TransportNetwork,
         hexgrid: gpd.GeoDataFrame,
-        destination=dst.DestinationSet) -> gpd.GeoDataFrame:
-    
-    log.info(msg=f"Instantiating TravelTimeMatrixComputer for {destination.name}")
-    travel_time_matrix_computer = r5py.TravelTimeMatrixComputer(
-        transport_network=transit,
-        origins=hexgrid,
-        destinations=destination.destinations,
-        departure=departure_time(transit, destination),
-        departure_time_window=datetime.timedelta(minutes=60),
-        transport_modes=[r5py.TransportMode.WALK, r5py.TransportMode.TRANSIT],
-        percentiles=[10,90]
+        destination=dst.DestinationSet,
+        travel_times: pd.DataFrame = None) -> pd.DataFrame:
+
+    if travel_times is None:
+        travel_times = travel_time_matrix(transit, hexgrid, destination, percentiles=[10, 90])
+
+    aggregates = difference_aggregates(travel_times, destination)
+    result = mean_from_aggregates(aggregates).to_frame(name=f"difference_{destination.name}")
+    return result
+
+
+def median_aggregates(travel_times: pd.DataFrame, destination: dst.DestinationSet) -> pd.DataFrame:
+    """Sums and counts of median travel times per cell"""
+    return aggregate_travel_times(
+        keys=travel_times[origin_key(destination)],
+        values=travel_times[percentile_column(travel_times, 50)].to_numpy(
+            dtype="float64", na_value=np.nan
+        ),
+        weights=cell_weights(travel_times, destination),
+        variance_weights=variance_weights(travel_times, destination),
     )
-    log.info(
-        msg=f"Computing Travel Time Matrix for {destination.name}. This might take a while ..."
+
+
+def difference_aggregates(travel_times: pd.DataFrame, destination: dst.DestinationSet) -> pd.DataFrame:
+    """Sums and counts of differences between 90th and 10th percentile travel times per cell"""
+    difference = travel_times["travel_time_p90"].to_numpy(
+        dtype="float64", na_value=np.nan
+    ) - travel_times["travel_time_p10"].to_numpy(dtype="float64", na_value=np.nan)
+    return aggregate_travel_times(
+        keys=travel_times[origin_key(destination)],
+        values=difference,
+        weights=cell_weights(travel_times, destination),
+        variance_weights=variance_weights(travel_times, destination),
     )
-    travel_times = travel_time_matrix_computer.compute_travel_times()
-    log.info(msg="Finished calculating travel times")
 
-    difference = travel_times["travel_time_p90"] - travel_times["travel_time_p10"]
-    travel_times["difference"] = difference
 
+def origin_key(destination: dst.DestinationSet) -> str:
+    """
+    Returns the travel time column the metrics are grouped by.
+    For reversed DestinationSets the hexgrid cells are the destinations of the routing.
+    """
     if destination.reversed:
-        travel_time_pivot = travel_times.pivot(
-            index="to_id", columns="from_id", values="difference"
-        )
+        return "to_id"
+    return "from_id"
+
+
+def cell_weights(travel_times: pd.DataFrame, destination: dst.DestinationSet) -> np.ndarray | None:
+    """
+    Returns the weight of the cell averaged over for every travel time row.
+    Weights come from a "weight" column of the destinations, e.g. of a mixed resolution grid.
+    return: array of weights, None if the destinations are unweighted
+    """
+    if "weight" not in destination.destinations.columns:
+        return None
+    other_key = "from_id" if destination.reversed else "to_id"
+    weights = destination.destinations.set_index("id")["weight"]
+    return travel_times[other_key].map(weights).fillna(1).to_numpy(dtype="float64")
+
+
+def variance_weights(travel_times: pd.DataFrame, destination: dst.DestinationSet) -> np.ndarray | None:
+    """
+    Returns (1 - inclusion probability) x weight^2 for every travel time row of sampled destinations,
+    the factor of each row in the variance of a weighted mean under Poisson sampling.
+    return: array of variance weights, None if the destinations are not a sample
+    """
+    if "inclusion" not in destination.destinations.columns:
+        return None
+    other_key = "from_id" if destination.reversed else "to_id"
+    cells = destination.destinations.set_index("id")
+    # cells outside the sample, e.g. origins of reversed DestinationSets, are fully observed
+    inclusion = travel_times[other_key].map(cells["inclusion"]).fillna(1).to_numpy(dtype="float64")
+    weights = travel_times[other_key].map(cells["weight"]).fillna(1).to_numpy(dtype="float64")
+    return (1 - inclusion) * weights**2
+
+
+def aggregate_travel_times(
+    keys: pd.Series,
+    values: np.ndarray,
+    weights: np.ndarray = None,
+    variance_weights: np.ndarray = None,
+) -> pd.DataFrame:
+    """
+    Reduces long form travel times to sums and counts of valid values per cell,
+    without materialising an origins x destinations pivot.
+    param: keys: cell ids for every travel time row
+    param: values: float travel times (or differences), NaN for unreachable pairs
+    param: weights: (Optional) weight of every row, counts are then sums of weights
+    param: variance_weights: (Optional) see variance_weights, adds the sums needed for confidence intervals
+    return: DataFrame with "sum" and "count" columns indexed by cell id
+    """
+    codes, ids = pd.factorize(keys)
+    valid = ~np.isnan(values)
+    if weights is None:
+        sums = np.bincount(codes[valid], weights=values[valid], minlength=len(ids))
+        counts = np.bincount(codes[valid], minlength=len(ids))
     else:
-        travel_time_pivot = travel_times.pivot(
-            index="from_id", columns="to_id", values="difference"
+        sums = np.bincount(
+            codes[valid], weights=values[valid] * weights[valid], minlength=len(ids)
         )
-    
-    result = travel_time_pivot
-    result[f"difference_{destination.name}"] = travel_time_pivot.mean(axis=1)
-    result = result[[f"difference_{destination.name}"]]
-    return result
-    
+        counts = np.bincount(codes[valid], weights=weights[valid], minlength=len(ids))
+    aggregates = pd.DataFrame(
+        {"sum": sums, "count": counts}, index=pd.Index(ids, name=keys.name)
+    )
+    if variance_weights is not None:
+        codes, values, variance_weights = codes[valid], values[valid], variance_weights[valid]
+        for column, terms in (
+            ("variance_count", variance_weights),
+            ("variance_sum", variance_weights * values),
+            ("variance_sum_sq", variance_weights * values**2),
+        ):
+            aggregates[column] = np.bincount(codes, weights=terms, minlength=len(ids))
+    return aggregates
+
+
+def dense_aggregates(
+    keys: pd.Index,
+    values: np.ndarray,
+    axis: int,
+    weights: np.ndarray = None,
+    variance_weights: np.ndarray = None,
+) -> pd.DataFrame:
+    """
+    Reduces a block of an origins x destinations matrix to the same sums and counts as aggregate_travel_times.
+    param: keys: cell ids along the axis that is kept
+    param: values: 2d float array, NaN for unreachable pairs
+    param: axis: axis summed over, 1 to aggregate per origin and 0 per destination
+    param: weights: (Optional) weight of every cell along the summed axis
+    param: variance_weights: (Optional) variance weight of every cell along the summed axis
+    return: DataFrame with "sum" and "count" columns indexed by cell id
+    """
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    shape = (1, -1) if axis == 1 else (-1, 1)
+    weights = valid if weights is None else valid * weights.reshape(shape)
+    aggregates = pd.DataFrame(
+        {"sum": (values * weights).sum(axis=axis), "count": weights.sum(axis=axis)},
+        index=pd.Index(keys, name="from_id" if axis == 1 else "to_id"),
+    )
+    if variance_weights is not None:
+        variance_weights = valid * variance_weights.reshape(shape)
+        aggregates["variance_count"] = variance_weights.sum(axis=axis)
+        aggregates["variance_sum"] = (variance_weights * values).sum(axis=axis)
+        aggregates["variance_sum_sq"] = (variance_weights * values**2).sum(axis=axis)
+    return aggregates
+
+
+def combine_aggregates(aggregates: list[pd.DataFrame]) -> pd.DataFrame:
+    """Adds up sums and counts of several chunks of travel times"""
+    if len(aggregates) == 1:
+        return aggregates[0]
+    return pd.concat(aggregates).groupby(level=0).sum()
+
+
+def mean_from_aggregates(aggregates: pd.DataFrame) -> pd.Series:
+    """Returns the mean per cell, NaN for cells without any reachable pair"""
+    return aggregates["sum"] / aggregates["count"].where(aggregates["count"] > 0)
+
+
+def interval_from_aggregates(aggregates: pd.DataFrame, z: float = 1.96) -> pd.Series:
+    """
+    Returns the half width of the confidence interval of the mean per cell from sampled destinations.
+    Uses the linearised variance of a weighted mean, sum(v * (t - mean)^2) / count^2.
+    param: aggregates: DataFrame from aggregate_travel_times with variance columns
+    param: z: quantile of the normal distribution, 1.96 for a 95% interval
+    return: half width in minutes, NaN for cells without any reachable pair
+    """
+    mean = mean_from_aggregates(aggregates)
+    variance = (
+        aggregates["variance_sum_sq"]
+        - 2 * mean * aggregates["variance_sum"]
+        + mean**2 * aggregates["variance_count"]
+    ) / aggregates["count"].where(aggregates["count"] > 0) ** 2
+    return z * np.sqrt(variance.clip(lower=0))
+
+
+def percentile_column(travel_times: pd.DataFrame, percentile: int) -> str:
+    """
+    Returns the name of the travel time column for a percentile.
+    r5py names the column "travel_time" if only one percentile was requested.
+    """
+    column = f"travel_time_p{percentile}"
+    if column in travel_times.columns:
+        return column
+    return "travel_time"
 
 
 def departure_time(
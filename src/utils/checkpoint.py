@@ -0,0 +1,62 @@
+import hashlib
+import logging as log
+import shutil
+import pandas as pd
+import geopandas as gpd
+import utils.cache as cache
+import utils.destination as dst
+from pathlib import Path
+
+
+class Checkpoints:
+    """Class for on-disk checkpoints of results per DestinationSet, so interrupted runs can resume"""
+
+    def __init__(self, fingerprint: str, cache_dir: Path = cache.CACHE_DIR) -> None:
+        """
+        param: fingerprint: identifies network, grid and metrics of a run, see fingerprint()
+        param: cache_dir: directory in which a checkpoints folder is created
+        """
+        self.path = Path(cache_dir, "checkpoints", fingerprint)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, destination: dst.DestinationSet) -> Path:
+        departure = destination.departure_time.strftime("%H%M")
+        direction = "reversed" if destination.reversed else "forward"
+        return Path(self.path, f"{destination.name}_{departure}_{direction}.parquet")
+
+    def load(self, destination: dst.DestinationSet) -> pd.DataFrame | None:
+        """
+        Returns the checkpointed result of a DestinationSet.
+        return: pd.DataFrame or None if it hasn't been computed yet
+        """
+        checkpoint = self._file(destination)
+        if not checkpoint.exists():
+            return None
+        log.info(f"Resuming {destination.name} from checkpoint {checkpoint}")
+        return pd.read_parquet(checkpoint)
+
+    def save(self, destination: dst.DestinationSet, result: pd.DataFrame) -> None:
+        """Saves the result of a DestinationSet. Safe to call from worker threads."""
+        checkpoint = self._file(destination)
+        temporary = checkpoint.with_suffix(".tmp")
+        result.to_parquet(temporary)
+        temporary.replace(checkpoint)
+
+    def clear(self) -> None:
+        """Removes all checkpoints of the run once its results are written"""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def fingerprint(network_key: str, hexgrid: gpd.GeoDataFrame, *settings) -> str:
+    """
+    Returns a fingerprint of a run from its transport network, grid and metric settings.
+    param: network_key: key of the transport network, e.g. from NetworkCache.key
+    param: hexgrid: gpd.GeoDataFrame with an id column of the routed cells
+    param: settings: further values that change results, e.g. percentiles
+    return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(network_key.encode())
+    digest.update("\n".join(sorted(hexgrid["id"])).encode())
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
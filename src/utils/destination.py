@@ -1,31 +1,50 @@
 import sys
 import logging as log
 import geopandas as gpd
+import h3
+import numpy as np
 import osmnx as ox
 import pandas as pd
 import pyrosm
+import requests
+import shapely
 import datetime
 from enum import Enum, auto
 from typing import Union
 import utils.gtfs as gtfs
 import utils.osmfile as osm
 import utils.raster as raster
+import utils.cache as cache
+import utils.geocache as geocache
 from dataclasses import dataclass
 from pathlib import Path
 from shapely.geometry import mapping
 
 
-def geocoding(place_name: Union[str, list]) -> gpd.GeoDataFrame:
+def geocoding(
+    place_name: Union[str, list], geocode_cache: geocache.GeocodeCache = None
+) -> gpd.GeoDataFrame:
     """
     Nominatim place name lookup via osmnx. Returns first result.
     Retries with user input if no result found.
     param: place_name: string or list of strings with placenames to geocode
+    param: geocode_cache: (Optional) GeocodeCache to look up places in before querying Nominatim
     return: gpd.GeoDataFrame
     """
     while True:
+        if geocode_cache is not None:
+            cached_place = geocode_cache.get(place_name)
+            if cached_place is not None:
+                log.info(f"Found {place_name} in geocode cache")
+                return cached_place
         try:
-            return ox.geocode_to_gdf(query=place_name)
-        except ConnectionError:
+            place = ox.geocode_to_gdf(query=place_name)
+        except (ConnectionError, requests.exceptions.RequestException):
+            if geocode_cache is not None:
+                stale_place = geocode_cache.get(place_name, stale=True)
+                if stale_place is not None:
+                    log.warning(f"Nominatim is unreachable, using expired cache entry for {place_name}")
+                    return stale_place
             log.critical(
                 msg="This operation needs a network connection. Terminating application"
             )
@@ -40,6 +59,24 @@ def geocoding(place_name: Union[str, list]) -> gpd.GeoDataFrame:
                 sys.exit()
             else:
                 continue
+        if geocode_cache is not None:
+            geocode_cache.put(place_name, place)
+        return place
+
+
+def boundaries_from_file(path: Path) -> gpd.GeoDataFrame:
+    """
+    Reads place boundaries for the geocode cache from a local file.
+    osm.pbf files are read with pyrosm, any other file with geopandas.
+    param: path: path to an osm.pbf file or a vector file with a name column
+    return: gpd.GeoDataFrame with name, geometry and, if present, admin_level columns in EPSG:4326
+    """
+    if str(path).endswith(".osm.pbf"):
+        boundaries = pyrosm.pyrosm.OSM(str(path)).get_boundaries()
+    else:
+        boundaries = gpd.read_file(path)
+    columns = [column for column in ("name", "admin_level", "geometry") if column in boundaries.columns]
+    return boundaries[columns].to_crs("EPSG:4326")
 
 def buffer(data: gpd.GeoDataFrame, buffer: int) -> gpd.GeoDataFrame:
     """
@@ -78,33 +115,170 @@ def counties_to_hexgrids(counties: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     return hexgrid
 
 
-def places_to_hexgrids(place: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+def places_to_hexgrids(place: gpd.GeoDataFrame, resolution: int = 9) -> gpd.GeoDataFrame:
     """
     Extracts counties from osmnx query dataframe and overlays h3 hexgrid.
     ## Parameters
     place: GeoDataFrame with places geocoded with osmnx
+    resolution: (Optional) h3 resolution of the grid
     ## Return
     hexgrid: gpd.GeoDataFrame with hexgrids
     """
     # TODO resolution = 9 might be a bit coarse for results but brings enormous savings
     
-    hexgrid = place.h3.polyfill_resample(9)
+    hexgrid = place.h3.polyfill_resample(resolution)
     hexgrid.reset_index(inplace=True)
     hexgrid.rename(columns={"h3_polyfill": "id"}, inplace=True)
     return hexgrid
 
-def places_to_pop_hexgrids(place: gpd.GeoDataFrame, pop_data: str) -> gpd.GeoDataFrame:
-    populated_place = raster.gdf_to_data_raster(place, pop_data)
-    # TODO use h3pandas to aggregate population density data
-    # TODO use hexgrid areas to get population per cell
-    hexgrid = populated_place.h3.polyfill_resample(9)
-    hexgrid_with_areas = hexgrid.h3.cell_area()
-    hexgrid['population'] = hexgrid_with_areas['h3_cell_area'] * hexgrid_with_areas['pop_density']
-    hexgrid.reset_index(inplace=True)
-    hexgrid.rename(columns={"h3_polyfill": "id"}, inplace=True)
+def places_to_pop_hexgrids(
+    place: gpd.GeoDataFrame,
+    pop_data: str,
+    cache_dir: Path = cache.CACHE_DIR,
+    resolution: int = 9,
+) -> gpd.GeoDataFrame:
+    """
+    Overlays h3 hexgrid on places and adds the population of each cell from a raster.
+    ## Parameters
+    place: GeoDataFrame with places geocoded with osmnx
+    pop_data: path to the population raster or a directory of raster tiles
+    cache_dir: (Optional) directory for cached raster windows
+    resolution: (Optional) h3 resolution of the grid
+    ## Return
+    hexgrid: gpd.GeoDataFrame with hexgrids and a population column
+    """
+    hexgrid = places_to_hexgrids(place, resolution=resolution)[["id", "geometry"]]
+    population = raster.population_per_cell(
+        place, pop_data, resolution=resolution, cache_dir=cache_dir
+    )
+    hexgrid = hexgrid.assign(population=hexgrid["id"].map(population).fillna(0))
     hexgrid = hexgrid.clip(mask=place, keep_geom_type=True)
     return hexgrid
-    
+
+
+def refinement_candidates(
+    hexgrid: gpd.GeoDataFrame,
+    metric: pd.Series,
+    population_threshold: float,
+    gradient_threshold: float,
+) -> list[str]:
+    """
+    Selects cells of a coarse grid that need a finer resolution.
+    param: hexgrid: GeoDataFrame with id and population columns
+    param: metric: travel time metric indexed by cell id, e.g. median closeness at a probe departure time
+    param: population_threshold: cells with at least this population are refined
+    param: gradient_threshold: cells whose metric differs from a neighbour by more than this are refined
+    return: list of cell ids to refine
+    """
+    refine = set(hexgrid.loc[hexgrid["population"] >= population_threshold, "id"])
+    metric = metric.dropna()
+    for cell, value in metric.items():
+        neighbours = metric.reindex(list(h3.k_ring(cell, 1))).dropna()
+        if (neighbours - value).abs().max() > gradient_threshold:
+            refine.add(cell)
+    log.info(f"Refining {len(refine)} of {len(hexgrid)} cells")
+    return sorted(refine)
+
+
+def coarsen_hexgrid(hexgrid: gpd.GeoDataFrame, resolution: int) -> gpd.GeoDataFrame:
+    """
+    Merges the cells of a grid into their parent cells at a coarser resolution.
+    Parents cover exactly the cells of the grid, so cells at the boundary of a place are kept.
+    param: hexgrid: GeoDataFrame with id, population and geometry columns, e.g. from places_to_pop_hexgrids
+    param: resolution: h3 resolution of the parents
+    return: gpd.GeoDataFrame with id, population, weight and geometry columns,
+        the weight is the number of cells a parent stands for
+    """
+    children = hexgrid.assign(
+        id=[h3.h3_to_parent(cell, resolution) for cell in hexgrid["id"]],
+        weight=hexgrid["weight"] if "weight" in hexgrid.columns else 1,
+    )
+    coarse = children[["id", "population", "weight", "geometry"]].dissolve(
+        by="id", aggfunc="sum"
+    )
+    return coarse.reset_index()[["id", "population", "weight", "geometry"]]
+
+
+def refine_hexgrid(
+    hexgrid: gpd.GeoDataFrame, fine_hexgrid: gpd.GeoDataFrame, cells: list[str]
+) -> gpd.GeoDataFrame:
+    """
+    Replaces cells of a coarse grid by their children in a fine grid.
+    The coarse grid has to be built with coarsen_hexgrid from the fine grid, then every cell
+    is weighted by the number of fine cells it covers and closeness over the mixed grid
+    approximates closeness over the uniform fine grid.
+    param: hexgrid: GeoDataFrame with id, population, weight and geometry columns from coarsen_hexgrid
+    param: fine_hexgrid: GeoDataFrame with id, population and geometry columns the coarse grid was built from
+    param: cells: list of coarse cell ids to refine
+    return: gpd.GeoDataFrame with id, population, weight and geometry columns
+    """
+    resolution = h3.h3_get_resolution(hexgrid["id"].iloc[0])
+    refine = set(cells)
+    parents = pd.Series(
+        [h3.h3_to_parent(cell, resolution) for cell in fine_hexgrid["id"]],
+        index=fine_hexgrid.index,
+    )
+    refined = fine_hexgrid.loc[parents.isin(refine), ["id", "population", "geometry"]]
+    refined = refined.assign(weight=1)
+
+    kept = hexgrid[~hexgrid["id"].isin(refine)]
+    return pd.concat([kept, refined], ignore_index=True)
+
+
+def sample_hexgrid(
+    hexgrid: gpd.GeoDataFrame, size: int, strata_resolution: int = 6, seed: int = 0
+) -> gpd.GeoDataFrame:
+    """
+    Draws a population weighted sample of cells stratified by their h3 parent cell,
+    so that closeness over the sample estimates closeness over every cell.
+    Strata get a share of the sample size proportional to their number of cells,
+    within a stratum cells are drawn with a probability proportional to their population.
+    param: hexgrid: GeoDataFrame with id, population and optionally weight columns
+    param: size: expected number of sampled cells
+    param: strata_resolution: h3 resolution of the strata
+    param: seed: seed of the random draw, a fixed seed keeps the sample stable between runs
+    return: gpd.GeoDataFrame with the sampled cells, weights divided by their inclusion
+        probability and an inclusion column holding that probability
+    """
+    if size >= len(hexgrid):
+        return hexgrid
+
+    strata = pd.Series(
+        [
+            h3.h3_to_parent(cell, min(strata_resolution, h3.h3_get_resolution(cell)))
+            for cell in hexgrid["id"]
+        ],
+        index=hexgrid.index,
+    )
+    measure = hexgrid["population"].clip(lower=0) + 1
+    allocation = size * strata.map(strata.value_counts()) / len(hexgrid)
+    inclusion = (allocation * measure / measure.groupby(strata).transform("sum")).clip(upper=1)
+
+    rng = np.random.default_rng(seed)
+    drawn = rng.random(len(hexgrid)) < inclusion.to_numpy()
+    sample = hexgrid[drawn].copy()
+    weight = sample["weight"] if "weight" in sample.columns else 1
+    sample["weight"] = weight / inclusion[drawn]
+    sample["inclusion"] = inclusion[drawn]
+    log.info(
+        f"Sampled {len(sample)} of {len(hexgrid)} cells from {strata.nunique()} strata as destinations"
+    )
+    return sample
+
+
+def prune_unpopulated(hexgrid: gpd.GeoDataFrame, threshold: float = 0) -> gpd.GeoDataFrame:
+    """
+    Removes cells without population before routing. Routing cost is quadratic in cell count.
+    param: hexgrid: GeoDataFrame with a population column
+    param: threshold: cells with a population at or below this value are removed
+    return: GeoDataFrame with the populated cells
+    """
+    populated = hexgrid[hexgrid["population"] > threshold]
+    log.info(
+        f"Pruned {len(hexgrid) - len(populated)} of {len(hexgrid)} cells with population <= {threshold}"
+    )
+    return populated
+
 
 class DestinationEnum(Enum):
     OSM_SCHOOLS_MORNING = auto()
@@ -125,19 +299,24 @@ class DestinationSet:
     destinations: gpd.GeoDataFrame
     departure_time: datetime.time
     reversed: bool = False
+    window: datetime.timedelta = datetime.timedelta(minutes=60)
 
 
 def osm_destination_set(
-    osm_file: osm.OSMFile, desired_destination: DestinationEnum
+    osm_file: osm.OSMFile,
+    desired_destination: DestinationEnum,
+    place: gpd.GeoDataFrame = None,
+    cache_dir: Path = cache.CACHE_DIR,
 ) -> DestinationSet:
     """
     Extracts predefined destinations from OSM data.
     param: osm_file: OSMFile loaded with osmfile module.
     param: desired_destination: destination entry from DestinationEnum
+    param: place: (Optional) GeoDataFrame with the area to extract, e.g. the buffered place. Defaults to the whole file
+    param: cache_dir: (Optional) directory for cached destinations
     return: DestinationSet
     """
     name = osm_file.name + desired_destination.name
-    osm_data = osm_file.load_osm_data()
 
     match desired_destination:
         case DestinationEnum.OSM_SCHOOLS_MORNING:
@@ -150,7 +329,10 @@ def osm_destination_set(
             custom_filter = {"amenity": ["school"]}
             reversed = True
 
-    gdf = extract_destinations(osm_data=osm_data, filter=custom_filter)
+    area = None if place is None else place.to_crs("EPSG:4326").unary_union
+    gdf = extract_destinations(
+        osm_file=osm_file, filter=custom_filter, area=area, cache_dir=cache_dir
+    )
 
     return DestinationSet(
         name=name, destinations=gdf, departure_time=time, reversed=reversed
@@ -180,39 +362,52 @@ def local_destination_set(
     return DestinationSet(name=name, destinations=gdf, departure_time=time)
 
 
-def destination_sets_from_dataframe(data: gpd.GeoDataFrame, times: Enum) -> list[DestinationSet]:
+def destination_sets_from_dataframe(
+    data: gpd.GeoDataFrame,
+    times: Enum,
+    window: datetime.timedelta = datetime.timedelta(minutes=60),
+) -> list[DestinationSet]:
     destinations = []
     for time in times:
         destination = DestinationSet(
             name="self" + time.name,
             destinations=centroids(hexgrid=data),
             departure_time=time.value,
+            window=window,
         )
         destinations.append(destination)
     return destinations
 
 
 
-def extract_destinations(osm_data: pyrosm.pyrosm.OSM, filter: dict) -> gpd.GeoDataFrame:
-    # TODO extracting osm destinations seems to just quietly fail if the data set is too large
-    log.debug(f"Attempting to extract osm data with pyrosm for {filter}")
-    destinations = osm_data.get_data_by_custom_criteria(custom_filter=filter)
-    log.info("extracted destinations from osm data")
-    destinations_centroids = destinations.copy()
-    log.debug("creating centroids")
-    destinations_centroids["geometry"] = destinations.centroid
-    return destinations_centroids
+def extract_destinations(
+    osm_file: osm.OSMFile,
+    filter: dict,
+    area: shapely.Geometry = None,
+    cache_dir: Path = cache.CACHE_DIR,
+) -> gpd.GeoDataFrame:
+    """
+    Extracts centroids of OSM features matching a pyrosm style custom filter.
+    The osm.pbf file is streamed instead of loaded, results are cached per file, filter and area.
+    param: osm_file: OSMFile to extract from
+    param: filter: dict of tag keys and lists of accepted values, e.g. {"amenity": ["school"]}
+    param: area: (Optional) shapely geometry in EPSG:4326 whose bounds the destinations have to be in
+    param: cache_dir: (Optional) directory for cached destinations
+    return: gpd.GeoDataFrame with centroids of the matching features
+    """
+    log.debug(f"Attempting to extract osm data for {filter}")
+    return osm.extract_pois(osm_file.path, filter, area=area, cache_dir=cache_dir)
 
 
 def destinations_from_osm(
-    osm_data: pyrosm.pyrosm.OSM, desired_destination: DestinationEnum.__members__
+    osm_file: osm.OSMFile, desired_destination: DestinationEnum.__members__
 ) -> gpd.GeoDataFrame:
     if desired_destination is DestinationEnum.SCHOOLS:
         filter = {"amenity": ["school"]}
     else:
         raise NotImplementedError
 
-    destinations = extract_destinations(osm_data=osm_data, filter=filter)
+    destinations = extract_destinations(osm_file=osm_file, filter=filter)
     return destinations
 
 
@@ -226,7 +421,7 @@ def centroids(hexgrid: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
 
 def find_batch_destinations(
-    osm_data: pyrosm.pyrosm.OSM,
+    osm_file: osm.OSMFile,
     desired_destination: DestinationEnum.__members__,
     county_hexgrids: gpd.GeoDataFrame = None,
 ) -> gpd.GeoDataFrame:
@@ -240,7 +435,7 @@ def find_batch_destinations(
         destinations = pd.concat(centroid_list, ignore_index=True)
         return destinations
 
-    destinations = destinations_from_osm(osm_data, desired_destination)
+    destinations = destinations_from_osm(osm_file, desired_destination)
     return destinations
 
 
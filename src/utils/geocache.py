@@ -0,0 +1,129 @@
+import datetime
+import json
+import logging as log
+import sqlite3
+import geopandas as gpd
+import pandas as pd
+import utils.cache as cache
+from contextlib import closing
+from pathlib import Path
+
+
+class GeocodeCache:
+    """Class for a persistent cache of geocoded place boundaries"""
+
+    def __init__(
+        self,
+        path: Path = Path(cache.CACHE_DIR, "geocode.sqlite"),
+        ttl: datetime.timedelta = datetime.timedelta(days=90),
+    ) -> None:
+        """
+        param: path: location of the SQLite cache file
+        param: ttl: time after which online results are looked up again, preloaded boundaries never expire
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS places "
+            "(query TEXT PRIMARY KEY, geojson TEXT, fetched REAL)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS preloads (source TEXT PRIMARY KEY)")
+        return connection
+
+    def get(self, query: str, stale: bool = False) -> gpd.GeoDataFrame | None:
+        """
+        Returns the cached boundary of a place.
+        param: query: place name as passed to the geocoder
+        param: stale: (Optional) if True also returns results older than the ttl
+        return: gpd.GeoDataFrame in EPSG:4326 or None if there is no valid entry
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT geojson, fetched FROM places WHERE query = ?", (normalise(query),)
+            ).fetchone()
+        if row is None:
+            return None
+
+        geojson, fetched = row
+        expired = (
+            fetched is not None
+            and datetime.datetime.now().timestamp() - fetched > self.ttl.total_seconds()
+        )
+        if expired and not stale:
+            return None
+        return gpd.GeoDataFrame.from_features(json.loads(geojson)["features"], crs="EPSG:4326")
+
+    def put(self, query: str, place: gpd.GeoDataFrame, expires: bool = True) -> None:
+        """
+        Stores the boundary of a place.
+        param: query: place name as passed to the geocoder
+        param: place: gpd.GeoDataFrame with the geocoding result
+        param: expires: (Optional) if False the entry is kept regardless of the ttl
+        """
+        fetched = datetime.datetime.now().timestamp() if expires else None
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO places (query, geojson, fetched) VALUES (?, ?, ?)",
+                (normalise(query), place.to_crs("EPSG:4326").to_json(), fetched),
+            )
+
+    def preloaded(self, source: str) -> bool:
+        """Returns whether boundaries with a content hash were already preloaded, see preload"""
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT 1 FROM preloads WHERE source = ?", (source,)).fetchone()
+        return row is not None
+
+    def preload(
+        self, boundaries: gpd.GeoDataFrame, name_column: str = "name", source: str = None
+    ) -> int:
+        """
+        Stores boundaries from a local data set under their names, e.g. from extract_counties.
+        Of boundaries sharing a name only the one with the lowest admin_level is kept, like Nominatim ranks them.
+        Names that are still ambiguous are skipped and left to Nominatim.
+        param: boundaries: gpd.GeoDataFrame with one boundary per row
+        param: name_column: column holding the place names
+        param: source: (Optional) content hash of the file the boundaries were read from, recorded for preloaded
+        return: number of preloaded places
+        """
+        boundaries = boundaries[boundaries[name_column].notna()].copy()
+        boundaries["_key"] = boundaries[name_column].map(normalise)
+        if "admin_level" in boundaries.columns:
+            level = pd.to_numeric(boundaries["admin_level"], errors="coerce")
+            lowest = level.groupby(boundaries["_key"]).transform("min")
+            boundaries = boundaries[(level == lowest) | lowest.isna()]
+        ambiguous = boundaries["_key"].duplicated(keep=False)
+        if ambiguous.any():
+            log.warning(
+                f"Not preloading {boundaries.loc[ambiguous, '_key'].nunique()} place names shared by several boundaries, "
+                f"e.g. {boundaries.loc[ambiguous, name_column].iloc[0]}. They are geocoded with Nominatim."
+            )
+            boundaries = boundaries[~ambiguous]
+        boundaries = boundaries.drop(columns="_key").to_crs("EPSG:4326")
+        rows = (
+            (
+                normalise(feature["properties"][name_column]),
+                json.dumps({"type": "FeatureCollection", "features": [feature]}),
+                None,
+            )
+            for feature in boundaries.iterfeatures(na="null")
+        )
+        # one transaction for all rows, country extracts hold thousands of boundaries
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO places (query, geojson, fetched) VALUES (?, ?, ?)", rows
+            )
+            if source is not None:
+                connection.execute("INSERT OR IGNORE INTO preloads (source) VALUES (?)", (source,))
+        log.info(f"Preloaded {len(boundaries)} place boundaries into the geocode cache")
+        return len(boundaries)
+
+
+def normalise(query: str | list) -> str:
+    """Returns the cache key of a geocoder query"""
+    if isinstance(query, list):
+        return "|".join(normalise(part) for part in query)
+    return " ".join(query.split()).lower()
@@ -1,9 +1,15 @@
 import datetime
+import io
+import logging as log
 import os
 import geopandas as gpd
 import pandas as pd
+import shapely
 import zipfile
+import numpy as np
+import utils.cache as cache
 import utils.destination as destination
+import utils.osmfile as osm
 from pathlib import Path
 
 
@@ -19,9 +25,207 @@ class GTFS:
         else:
             raise NoGTFSFileError(message=f"Can't handle specified file at {self.path}")
 
-    def crop_gtfs(self, place: gpd.GeoDataFrame, inplace: bool = False):
-        raise NotImplementedError
-        # TODO crop gtfs to file
+    def has_table(self, table: str) -> bool:
+        """Checks if the feed contains a table, e.g. "shapes.txt" """
+        if self.archived:
+            with zipfile.ZipFile(self.path) as gtfs:
+                return table in gtfs.namelist()
+        return Path(self.path, table).exists()
+
+    def read_table(
+        self, table: str, chunksize: int = None, usecols: list = None, dtype=str
+    ):
+        """
+        Reads a table of the feed, by default with every value as a string.
+        param: table: file name within the feed, e.g. "stops.txt"
+        param: chunksize: (Optional) if set returns an iterator over DataFrames of this many rows
+        param: usecols: (Optional) columns to read
+        param: dtype: (Optional) dtype or dict of dtypes per column
+        return: pd.DataFrame or iterator of pd.DataFrames
+        """
+        chunks = self._read_chunks(table, chunksize, usecols, dtype)
+        if chunksize is not None:
+            return chunks
+        data = next(chunks)
+        chunks.close()
+        return data
+
+    def _read_chunks(
+        self, table: str, chunksize: int = None, usecols: list = None, dtype=str
+    ):
+        # empty fields of typed columns are missing values, string columns keep them as ""
+        na_values = None
+        if isinstance(dtype, dict):
+            na_values = {column: [""] for column, kind in dtype.items() if kind is not str}
+        options = dict(
+            dtype=dtype,
+            keep_default_na=False,
+            na_values=na_values,
+            encoding="utf-8-sig",
+            usecols=usecols,
+            chunksize=chunksize,
+        )
+        if self.archived:
+            with zipfile.ZipFile(self.path) as gtfs:
+                with gtfs.open(table) as table_file:
+                    if chunksize is None:
+                        yield pd.read_csv(table_file, **options)
+                    else:
+                        yield from pd.read_csv(table_file, **options)
+        elif chunksize is None:
+            yield pd.read_csv(Path(self.path, table), **options)
+        else:
+            yield from pd.read_csv(Path(self.path, table), **options)
+
+    def crop_gtfs(
+        self,
+        place: gpd.GeoDataFrame,
+        name: str = None,
+        inplace: bool = False,
+        chunksize: int = 1000000,
+        cache_dir: Path = cache.CACHE_DIR,
+    ):
+        """
+        Crops the feed to the stops within place and the trips serving them, into a new zip at <cache_dir>/gtfs/.
+        Large tables are streamed in chunks, so stop_times.txt is never loaded at once.
+        Trips are cut down to their stop times within place and kept if at least two remain.
+        Crops are keyed by the content of the feed and the area, so later runs reuse them.
+        If no trip remains the feed is left uncropped.
+        param: place: gpd.GeoDataFrame with the area to crop to
+        param: name: (Optional) sets the name of the cropped feed.
+        param: inplace: (Optional) If inplace is True the method returns nothing, else it returns a new GTFS object.
+        param: chunksize: (Optional) number of rows read at once from large tables
+        param: cache_dir: (Optional) directory in which a gtfs folder is created
+        return: Cropped GTFS object
+        """
+        if name is None:
+            name = self.name + "_cropped"
+        source = cache.file_digest(self.path, cache_dir=cache_dir)
+        save_path = Path(cache_dir, "gtfs", f"{osm.crop_name(source, place)}.zip")
+
+        if save_path.exists():
+            log.info(f"Reusing cropped gtfs feed {save_path}")
+            cache.touch(save_path)
+        else:
+            save_path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = save_path.with_suffix(".tmp")
+            if not self._write_crop(place, temporary_path, chunksize):
+                log.warning(
+                    f"No trips of gtfs feed {self.name} stop within the area. Keeping the feed uncropped."
+                )
+                temporary_path.unlink(missing_ok=True)
+                if not inplace:
+                    return self
+                return
+            temporary_path.replace(save_path)
+            log.info(f"cropped gtfs feed {name} saved at {save_path}")
+
+        if not inplace:
+            cropped_feed = GTFS(path=save_path)
+            cropped_feed.name = name
+            return cropped_feed
+
+        self.path = save_path
+        self.name = name
+        self.archived = True
+
+    def _write_crop(self, place: gpd.GeoDataFrame, target: Path, chunksize: int) -> bool:
+        """
+        Writes the cropped feed to target, see crop_gtfs.
+        return: False if no trip stops at least twice within place, nothing is written then
+        """
+        area = place.to_crs("EPSG:4326").unary_union
+
+        log.info(f"Cropping gtfs feed {self.name}. This might take a while...")
+        stops = self.read_table("stops.txt")
+        inside = shapely.contains_xy(
+            area,
+            pd.to_numeric(stops["stop_lon"], errors="coerce"),
+            pd.to_numeric(stops["stop_lat"], errors="coerce"),
+        )
+        stop_ids = set(stops.loc[inside, "stop_id"])
+        if not stop_ids:
+            return False
+
+        # first pass: trips with at least two stop times within the area
+        stop_counts = pd.Series(dtype=int)
+        for chunk in self.read_table("stop_times.txt", chunksize, ["trip_id", "stop_id"]):
+            counts = chunk.loc[chunk["stop_id"].isin(stop_ids), "trip_id"].value_counts()
+            stop_counts = stop_counts.add(counts, fill_value=0)
+        trip_ids = set(stop_counts.index[stop_counts >= 2])
+
+        if not trip_ids:
+            return False
+
+        with zipfile.ZipFile(target, "w") as cropped:
+            # second pass: stop times of kept trips within the area
+            used_stop_ids = set()
+            with cropped.open(zip_info("stop_times.txt"), "w") as table_file:
+                with io.TextIOWrapper(table_file, encoding="utf-8", newline="") as text:
+                    for position, chunk in enumerate(self.read_table("stop_times.txt", chunksize)):
+                        chunk = chunk[chunk["trip_id"].isin(trip_ids) & chunk["stop_id"].isin(stop_ids)]
+                        used_stop_ids.update(chunk["stop_id"])
+                        chunk.to_csv(text, header=position == 0, index=False)
+
+            stop_ids = used_stop_ids
+            if "parent_station" in stops.columns:
+                parents = stops.loc[stops["stop_id"].isin(stop_ids), "parent_station"]
+                stop_ids = stop_ids | set(parents[parents != ""])
+            write_table(cropped, "stops.txt", stops[stops["stop_id"].isin(stop_ids)])
+
+            trips = self.read_table("trips.txt")
+            trips = trips[trips["trip_id"].isin(trip_ids)]
+            write_table(cropped, "trips.txt", trips)
+
+            routes = self.read_table("routes.txt")
+            routes = routes[routes["route_id"].isin(trips["route_id"])]
+            write_table(cropped, "routes.txt", routes)
+
+            agency = self.read_table("agency.txt")
+            if "agency_id" in routes.columns and "agency_id" in agency.columns:
+                agency = agency[agency["agency_id"].isin(routes["agency_id"])]
+            write_table(cropped, "agency.txt", agency)
+
+            service_ids = set(trips["service_id"])
+            for table in ("calendar.txt", "calendar_dates.txt"):
+                if self.has_table(table):
+                    self._write_chunks(
+                        cropped, table, chunksize, lambda chunk: chunk["service_id"].isin(service_ids)
+                    )
+
+            if self.has_table("shapes.txt") and "shape_id" in trips.columns:
+                shape_ids = set(trips["shape_id"])
+                self._write_chunks(
+                    cropped, "shapes.txt", chunksize, lambda chunk: chunk["shape_id"].isin(shape_ids)
+                )
+
+            if self.has_table("frequencies.txt"):
+                self._write_chunks(
+                    cropped, "frequencies.txt", chunksize, lambda chunk: chunk["trip_id"].isin(trip_ids)
+                )
+
+            if self.has_table("transfers.txt"):
+                self._write_chunks(
+                    cropped,
+                    "transfers.txt",
+                    chunksize,
+                    lambda chunk: chunk["from_stop_id"].isin(stop_ids)
+                    & chunk["to_stop_id"].isin(stop_ids),
+                )
+
+            if self.has_table("feed_info.txt"):
+                write_table(cropped, "feed_info.txt", self.read_table("feed_info.txt"))
+
+        log.info(f"cropped gtfs feed with {len(stop_ids)} stops and {len(trip_ids)} trips")
+        return True
+
+
+    def _write_chunks(self, cropped: zipfile.ZipFile, table: str, chunksize: int, selection) -> None:
+        """Streams a table into the cropped feed, keeping the rows selected by a function of each chunk"""
+        with cropped.open(zip_info(table), "w") as table_file:
+            with io.TextIOWrapper(table_file, encoding="utf-8", newline="") as text:
+                for position, chunk in enumerate(self.read_table(table, chunksize)):
+                    chunk[selection(chunk)].to_csv(text, header=position == 0, index=False)
 
     def dataframe_from_stops(self) -> gpd.GeoDataFrame:
         """
@@ -43,18 +247,73 @@ class GTFS:
 
         return stops_gdf
 
-    def covers_location(self, other: gpd.GeoDataFrame) -> bool:
+    def stop_locations(self, cache_dir: Path = cache.CACHE_DIR) -> pd.DataFrame:
+        """
+        Returns the ids and coordinates of all stops with a location.
+        Only these columns are parsed, the result is cached as parquet keyed by the feed's content hash.
+        param: cache_dir: (Optional) directory in which a gtfs folder is created
+        return: pd.DataFrame with stop_id, stop_lon and stop_lat columns in EPSG:4326
+        """
+        digest = cache.file_digest(self.path, cache_dir=cache_dir)
+        stops_path = Path(cache_dir, "gtfs", f"{digest}_stops.parquet")
+        if stops_path.exists():
+            return pd.read_parquet(stops_path)
+
+        stops = self.read_table(
+            "stops.txt",
+            usecols=["stop_id", "stop_lon", "stop_lat"],
+            dtype={"stop_id": str, "stop_lon": "float64", "stop_lat": "float64"},
+        )
+        stops = stops.dropna(subset=["stop_lon", "stop_lat"]).reset_index(drop=True)
+        stops_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = stops_path.with_suffix(".tmp")
+        stops.to_parquet(temporary_path)
+        temporary_path.replace(stops_path)
+        return stops
+
+    def covers_location(
+        self,
+        other: gpd.GeoDataFrame,
+        cache_dir: Path = cache.CACHE_DIR,
+        batch_size: int = 100000,
+    ) -> bool:
         """
         Checks if there are stop locations within the unary union of the other dataframe.
+        Stops outside its bounding box are skipped, the rest are tested in batches until the first hit.
         Params: other: GeoDataFrame to check
+        param: cache_dir: (Optional) directory of the cached stop locations
+        param: batch_size: (Optional) number of stops tested against the area at once
         returns: bool: true if there's stop locations within the area
         """
-        stops = self.dataframe_from_stops()
-        local_stops = stops.clip(mask=other.unary_union)
-        if local_stops.empty:
-            return False
-        return True
-    
+        stops = self.stop_locations(cache_dir=cache_dir)
+        area = other.to_crs("EPSG:4326").unary_union
+        min_x, min_y, max_x, max_y = area.bounds
+        x = stops["stop_lon"].to_numpy()
+        y = stops["stop_lat"].to_numpy()
+        candidates = np.flatnonzero((x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+
+        shapely.prepare(area)
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start : start + batch_size]
+            if shapely.contains_xy(area, x[batch], y[batch]).any():
+                return True
+        return False
+
+
+def zip_info(table: str) -> zipfile.ZipInfo:
+    """Zip entry with a fixed timestamp, so identical crops produce identical files"""
+    info = zipfile.ZipInfo(table, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def write_table(cropped: zipfile.ZipFile, table: str, data: pd.DataFrame) -> None:
+    """Writes a DataFrame as a table into a zipped feed"""
+    with cropped.open(zip_info(table), "w") as table_file:
+        with io.TextIOWrapper(table_file, encoding="utf-8", newline="") as text:
+            data.to_csv(text, index=False)
+
+
 class NoGTFSFileError(Exception):
     """Error for not a valid gtfs file"""
     def __init__(self, message: str = None, *args: object) -> None:
@@ -0,0 +1,178 @@
+import datetime
+import json
+import logging as log
+import resource
+import threading
+import time
+import jpype
+from contextlib import contextmanager
+from pathlib import Path
+
+# finished spans of the current run, in the order they finished
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+_started = time.perf_counter()
+_started_at = datetime.datetime.now()
+# peak RSS in KiB of every open span and of the run, as seen before the last reset of the kernel's high-water mark
+_open_peaks = {}
+_run_peak = 0
+
+
+@contextmanager
+def span(name: str, **counts):
+    """
+    Records wall time, CPU time, peak RSS and JVM heap of a pipeline stage.
+    Counts, e.g. of rows or cells, can be passed up front or added to the yielded dict while the span runs.
+    CPU time is that of the whole process including JVM threads, so it overlaps for spans running in parallel.
+    Peak RSS is the highest RSS of the process while the span ran, measured by resetting the kernel's
+    high-water mark at its start. It is None where /proc doesn't allow that, e.g. outside Linux.
+    param: name: name of the stage, e.g. "routing"
+    param: counts: (Optional) initial counts of the span
+    return: dict of counts of the span
+    """
+    stack = getattr(_local, "stack", [])
+    _local.stack = stack
+    parent = stack[-1] if stack else None
+    stack.append(name)
+
+    counts = dict(counts)
+    key = object()
+    with _lock:
+        if reset_peak():
+            _open_peaks[key] = 0
+    wall_start = time.perf_counter()
+    cpu_start = cpu_seconds()
+    try:
+        yield counts
+    finally:
+        stack.pop()
+        with _lock:
+            peak = None
+            if key in _open_peaks:
+                update_peaks()
+                peak = _open_peaks.pop(key)
+        record = {
+            "name": name,
+            "parent": parent,
+            "thread": threading.current_thread().name,
+            "start_seconds": round(wall_start - _started, 3),
+            "wall_seconds": round(time.perf_counter() - wall_start, 3),
+            "cpu_seconds": round(cpu_seconds() - cpu_start, 3),
+            "peak_rss_mb": None if peak is None else round(peak / 1024, 1),
+            **jvm_heap_mb(),
+            "counts": counts,
+        }
+        with _lock:
+            _spans.append(record)
+        log.debug(f"{name} took {record['wall_seconds']}s, {record['cpu_seconds']}s CPU")
+
+
+def cpu_seconds() -> float:
+    """Returns user and system CPU time of the process and its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def high_water_kib() -> int | None:
+    """Returns the peak RSS in KiB since the high-water mark was last reset, None without /proc"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def update_peaks() -> int | None:
+    """Folds the current high-water mark into the peaks of the open spans and the run, call with _lock held"""
+    global _run_peak
+    high_water = high_water_kib()
+    if high_water is None:
+        return None
+    _run_peak = max(_run_peak, high_water)
+    for key in _open_peaks:
+        _open_peaks[key] = max(_open_peaks[key], high_water)
+    return high_water
+
+
+def reset_peak() -> bool:
+    """
+    Resets the kernel's high-water mark of the RSS, after folding it into the open spans, call with _lock held.
+    return: False if the mark can't be reset
+    """
+    if update_peaks() is None:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the process so far.
+    ru_maxrss is in KiB on Linux and is reset along with the high-water mark, so the peaks seen before count too.
+    """
+    with _lock:
+        update_peaks()
+        peak = max(_run_peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return peak / 1024
+
+
+def jvm_heap_mb() -> dict:
+    """Returns used and maximum heap of the JVM r5py runs in, empty if it isn't started"""
+    if not jpype.isJVMStarted():
+        return {}
+    runtime = jpype.java.lang.Runtime.getRuntime()
+    return {
+        "jvm_heap_used_mb": round((runtime.totalMemory() - runtime.freeMemory()) / 2**20, 1),
+        "jvm_heap_max_mb": round(runtime.maxMemory() / 2**20, 1),
+    }
+
+
+def report(**metadata) -> dict:
+    """
+    Returns the run report with all finished spans.
+    param: metadata: (Optional) further values describing the run, e.g. its arguments
+    """
+    with _lock:
+        spans = list(_spans)
+    return {
+        "started": _started_at.isoformat(timespec="seconds"),
+        "wall_seconds": round(time.perf_counter() - _started, 3),
+        "cpu_seconds": round(cpu_seconds(), 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        **metadata,
+        "spans": spans,
+    }
+
+
+def save_report(path: Path, **metadata) -> Path:
+    """
+    Writes the run report as JSON.
+    param: path: file to write
+    param: metadata: (Optional) further values describing the run, e.g. its arguments
+    return: path to the report
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report(**metadata), indent=2, default=str))
+    log.info(f"Saved run report to {path}")
+    return path
+
+
+def reset() -> None:
+    """Discards all recorded spans and restarts the run clock and peak RSS, e.g. between benchmark runs"""
+    global _started, _started_at, _run_peak
+    with _lock:
+        _spans.clear()
+        _run_peak = 0
+        reset_peak()
+        _started = time.perf_counter()
+        _started_at = datetime.datetime.now()
@@ -0,0 +1,119 @@
+import logging as log
+import numpy as np
+import pandas as pd
+import zarr
+import utils.destination as dst
+from pathlib import Path
+
+# stored value of origin destination pairs without a connection
+UNREACHABLE = np.iinfo(np.uint16).max
+
+
+class MatrixStore:
+    """Class for a compressed on-disk store of travel time matrices, one per DestinationSet"""
+
+    def __init__(self, path: Path, chunk_origins: int = 512) -> None:
+        """
+        Matrices are stored as uint16 minutes in chunks of origins, so blocks of rows can be read on their own.
+        param: path: directory holding one zarr array per departure time and direction
+        param: chunk_origins: number of origins per stored chunk
+        """
+        self.path = Path(path)
+        self.chunk_origins = chunk_origins
+        self._indexes = {}
+
+    def _array_path(self, destination: dst.DestinationSet) -> Path:
+        departure = destination.departure_time.strftime("%H%M")
+        direction = "reversed" if destination.reversed else "forward"
+        return Path(self.path, f"{departure}_{direction}.zarr")
+
+    def create(
+        self, destination: dst.DestinationSet, origins: pd.Series, percentiles: list[int]
+    ) -> None:
+        """
+        Creates an empty matrix for a DestinationSet, replacing an earlier one.
+        param: destination: DestinationSet routed to
+        param: origins: cell ids of the routed origins in routing order
+        param: percentiles: travel time percentiles stored along the first axis
+        """
+        destination_ids = [str(id) for id in destination.destinations["id"]]
+        origin_ids = [str(id) for id in origins]
+        array = zarr.open_array(
+            store=str(self._array_path(destination)),
+            mode="w",
+            shape=(len(percentiles), len(origin_ids), len(destination_ids)),
+            chunks=(1, min(self.chunk_origins, max(1, len(origin_ids))), max(1, len(destination_ids))),
+            dtype="uint16",
+            fill_value=UNREACHABLE,
+        )
+        array.attrs.update(
+            {
+                "name": destination.name,
+                "departure_time": destination.departure_time.isoformat(),
+                "window_minutes": destination.window.total_seconds() / 60,
+                "percentiles": list(percentiles),
+                "origins": origin_ids,
+                "destinations": destination_ids,
+            }
+        )
+        self._indexes.pop(self._array_path(destination), None)
+
+    def index(self, destination: dst.DestinationSet) -> tuple[pd.Index, pd.Index, list[int]]:
+        """
+        Returns the ids along the axes of a stored matrix.
+        return: tuple of origin ids, destination ids and percentiles
+        """
+        path = self._array_path(destination)
+        if path not in self._indexes:
+            attributes = zarr.open_array(store=str(path), mode="r").attrs
+            self._indexes[path] = (
+                pd.Index(attributes["origins"], name="from_id"),
+                pd.Index(attributes["destinations"], name="to_id"),
+                list(attributes["percentiles"]),
+            )
+        return self._indexes[path]
+
+    def write(self, destination: dst.DestinationSet, travel_times: pd.DataFrame) -> None:
+        """
+        Stores the long form travel times of a block of consecutive origins, e.g. one routing chunk.
+        param: destination: DestinationSet the travel times were routed to
+        param: travel_times: DataFrame from centrality.travel_time_matrix
+        """
+        origins, destinations, percentiles = self.index(destination)
+        rows = origins.get_indexer(travel_times["from_id"].astype(str))
+        columns = destinations.get_indexer(travel_times["to_id"].astype(str))
+        first, last = rows.min(), rows.max() + 1
+
+        block = np.full((len(percentiles), last - first, len(destinations)), UNREACHABLE, dtype="uint16")
+        for position, percentile in enumerate(percentiles):
+            column = f"travel_time_p{percentile}"
+            if column not in travel_times.columns:
+                column = "travel_time"
+            minutes = travel_times[column].to_numpy(dtype="float64", na_value=np.nan)
+            reachable = ~np.isnan(minutes)
+            block[position, rows[reachable] - first, columns[reachable]] = np.clip(
+                np.rint(minutes[reachable]), 0, UNREACHABLE - 1
+            )
+        array = zarr.open_array(store=str(self._array_path(destination)), mode="r+")
+        array[:, first:last, :] = block
+
+    def blocks(self, destination: dst.DestinationSet):
+        """
+        Reads a stored matrix chunk by chunk.
+        return: iterator of tuples of origin ids and float minutes per percentile, origin and destination, NaN if unreachable
+        """
+        origins, _, _ = self.index(destination)
+        array = zarr.open_array(store=str(self._array_path(destination)), mode="r")
+        step = array.chunks[1]
+        for start in range(0, len(origins), step):
+            block = array[:, start : start + step, :]
+            minutes = np.where(block == UNREACHABLE, np.nan, block.astype("float64"))
+            yield origins[start : start + step], minutes
+
+    def stored(self) -> list[dict]:
+        """Returns the attributes of every stored matrix, e.g. to list the departure times"""
+        matrices = []
+        for path in sorted(self.path.glob("*.zarr")):
+            matrices.append(dict(zarr.open_array(store=str(path), mode="r").attrs))
+        log.debug(f"Found {len(matrices)} travel time matrices in {self.path}")
+        return matrices
@@ -0,0 +1,88 @@
+import logging as log
+from pathlib import Path
+import r5py
+import jpype
+import utils.cache as cache
+
+import com.conveyal.r5
+
+# read_network and write_network use the private layout of r5py 0.1's TransportNetwork,
+# the _transport_network attribute and the osm_file closed in __del__, so r5py is pinned to 0.1.
+# r5py 1.x caches built networks itself and would make this module unnecessary.
+
+
+class CachedOSM:
+    """Stand-in for the osm mapdb r5py keeps open, a deserialised network doesn't need one"""
+
+    def close(self) -> None:
+        pass
+
+
+class NetworkCache:
+    """Class for a size bounded on-disk cache of built r5py.TransportNetworks"""
+
+    def __init__(self, cache_dir: Path = cache.CACHE_DIR, budget: int = 20 * 2**30) -> None:
+        """
+        param: cache_dir: directory in which a networks folder is created
+        param: budget: maximum size of the cached networks in bytes
+        """
+        self.cache_dir = Path(cache_dir)
+        self.path = Path(cache_dir, "networks")
+        self.budget = budget
+
+    def key(self, osm_path: str, gtfs_path: str) -> str:
+        """
+        Returns the cache key of a network built from osm and gtfs data with the installed r5py.
+        """
+        osm_digest = cache.file_digest(osm_path, cache_dir=self.cache_dir)
+        gtfs_digest = cache.file_digest(gtfs_path, cache_dir=self.cache_dir)
+        return f"{osm_digest}_{gtfs_digest}_{r5py.__version__}"
+
+    def load_network(self, osm_path: str, gtfs_path: str) -> r5py.TransportNetwork:
+        """
+        Returns a TransportNetwork from the cache, or builds and caches it if missing.
+        param: osm_path: path to the osm.pbf file
+        param: gtfs_path: path to the gtfs feed
+        return: r5py.TransportNetwork
+        """
+        network_path = Path(self.path, f"{self.key(osm_path, gtfs_path)}.dat")
+
+        if network_path.exists():
+            try:
+                log.info(f"Loading cached transport network from {network_path}")
+                network = read_network(network_path)
+                cache.touch(network_path)
+                return network
+            except jpype.JException as error:
+                log.warning(f"Could not read cached transport network: {error}. Rebuilding.")
+                network_path.unlink()
+
+        network = r5py.TransportNetwork(osm_pbf=str(osm_path), gtfs=str(gtfs_path))
+        self.path.mkdir(parents=True, exist_ok=True)
+        write_network(network, network_path)
+        cache.evict_lru(self.path, budget=self.budget, pattern="*.dat", keep=[network_path])
+        return network
+
+
+def write_network(network: r5py.TransportNetwork, path: Path) -> None:
+    """Serialises the R5 network wrapped by an r5py.TransportNetwork with R5's kryo serializer"""
+    log.info(f"Saving transport network to {path}")
+    temporary_path = path.with_suffix(".tmp")
+    com.conveyal.r5.kryo.KryoNetworkSerializer.write(
+        network._transport_network, jpype.java.io.File(str(temporary_path))
+    )
+    temporary_path.replace(path)
+
+
+def read_network(path: Path) -> r5py.TransportNetwork:
+    """
+    Deserialises a network written by write_network into an r5py.TransportNetwork.
+    The instance is created without running the build steps in TransportNetwork.__init__,
+    which only works with the attributes r5py 0.1 sets there.
+    """
+    network = r5py.TransportNetwork.__new__(r5py.TransportNetwork)
+    network.osm_file = CachedOSM()
+    network._transport_network = com.conveyal.r5.kryo.KryoNetworkSerializer.read(
+        jpype.java.io.File(str(path))
+    )
+    return network
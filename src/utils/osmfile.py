@@ -1,13 +1,21 @@
 import os
+import functools
+import hashlib
+import json
 import logging as log
+import pickle
+import sqlite3
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import pyrosm
 import shapely
-import fiona
-
-
-import subprocess
+from contextlib import closing
+from pathlib import Path
+import osmium
+import time
+import utils.cache as cache
+import utils.instrumentation as instrumentation
 
 
 class ErrorMissingPath(Exception):
@@ -39,51 +47,44 @@ class OSMFile:
         else:
             raise ErrorMissingPath(message="Did not provide a filepath for OSMFile")
 
-    def crop(self, geodata: gpd.GeoDataFrame, name: str = None, inplace: bool = False):
+    def crop(
+        self,
+        geodata: gpd.GeoDataFrame,
+        name: str = None,
+        inplace: bool = False,
+        directory: Path = Path(cache.CACHE_DIR, "osm_data"),
+    ):
         """
-        Crops the OSM data to a new file at data/osm_data/.
-        param: geodata: gpd.GeoDataFrame sets bounds to which the OSM file will be cropped.
+        Crops the OSM data to the outline of geodata in a new file in directory.
+        Ways with at least one node inside the outline are kept complete. An existing crop of the same name is reused.
+        param: geodata: gpd.GeoDataFrame sets the outline to which the OSM file will be cropped.
         param: name: (Optional) sets the name of the cropped file.
         param: inplace: (Optional) If inplace is True the method returns nothing, else it returns a new OSMFile object.
+        param: directory: (Optional) folder of the cropped file
         return: Cropped OSMFile ob
         """
-        stop_bounds = geodata.total_bounds
-        left, bottom, right, top = stop_bounds
-        stops_extent = shapely.Polygon(
-            shell=((left, bottom), (right, bottom), (right, top), (left, top))
-        )
+        crop_extent = geodata.to_crs("EPSG:4326").unary_union
 
         if name is None:
             name = self.name + "_cropped"
 
-        save_path = f"osm_data/{name}.osm.pbf"
-
-        # cropping pbf to bounding box with osmosis
-        log.info("Cropping the OSM dataset with Osmosis. This might take a while...")
-        subprocess.run(
-            [
-                "osmosis",
-                "--read-pbf",
-                f"file={self.path}",
-                "--bounding-box",
-                f"top={top}",
-                f"left={left}",
-                f"bottom={bottom}",
-                f"right={right}",
-                "completeWays=yes",
-                "--write-pbf",
-                f"file={save_path}",
-            ]
-        )
-        log.info(f"cropped osm data set {name} saved at {save_path}")
+        save_path = str(Path(directory, f"{name}.osm.pbf"))
+
+        if os.path.exists(save_path):
+            log.info(f"Reusing cropped osm data set {save_path}")
+        else:
+            log.info("Cropping the OSM dataset. This might take a while...")
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            crop_pbf(source=self.path, target=save_path, area=crop_extent)
+            log.info(f"cropped osm data set {name} saved at {save_path}")
 
         if not inplace:
-            cropped_set = OSMFile(extent=stops_extent, path=save_path, name=name)
+            cropped_set = OSMFile(extent=crop_extent, path=save_path, name=name)
             return cropped_set
 
         self.name = name
         self.path = save_path
-        self.extent = stops_extent
+        self.extent = crop_extent
 
     def load_osm_data(self) -> pyrosm.pyrosm.OSM:
         """Returns pyrosm OSM data object"""
@@ -96,53 +97,359 @@ class OSMFile:
         return self.osm_data
 
 
+def crop_pbf(
+    source: str, target: str, area: shapely.Geometry, batch_size: int = 100000
+) -> None:
+    """
+    Crops an osm.pbf file to a polygon with pyosmium, keeping ways complete.
+    libosmium adds node locations to the ways and builds their geometries, which are tested
+    against the polygon in vectorised batches, so only ways and tagged nodes pass through python.
+    Relations referencing the kept objects and the remaining way nodes are then collected and
+    written by libosmium as well. The node location index of the first pass takes about 8 bytes per node.
+    param: source: path of the osm.pbf file to crop
+    param: target: path of the cropped osm.pbf file
+    param: area: shapely polygon in EPSG:4326
+    param: batch_size: number of geometries tested at once
+    """
+    start = time.perf_counter()
+    shapely.prepare(area)
+    tracker = osmium.IdTracker()
+    factory = osmium.geom.WKBFactory()
+    way_ids, lines = [], []
+
+    def track_ways():
+        inside = shapely.intersects(area, shapely.from_wkb(lines))
+        for way_id in np.asarray(way_ids, dtype=np.int64)[inside]:
+            tracker.add_way(int(way_id))
+        way_ids.clear()
+        lines.clear()
+
+    # pass 1: ways crossing the polygon
+    ways = (
+        osmium.FileProcessor(source, osmium.osm.NODE | osmium.osm.WAY)
+        .with_locations()
+        .with_filter(osmium.filter.EntityFilter(osmium.osm.WAY))
+    )
+    for count, way in enumerate(ways, start=1):
+        try:
+            # shapely parses binary WKB several times faster than the hex strings pyosmium returns
+            lines.append(bytes.fromhex(factory.create_linestring(way)))
+        except (osmium.InvalidLocationError, RuntimeError):
+            # ways with nodes missing from the extract or a single location
+            points = [(node.lon, node.lat) for node in way.nodes if node.location.valid()]
+            if not points:
+                continue
+            lines.append(shapely.MultiPoint(points).wkb)
+        way_ids.append(way.id)
+        if len(way_ids) >= batch_size:
+            track_ways()
+        if count % 10000000 == 0:
+            log.info(f"Cropping: checked {count} ways ({time.perf_counter() - start:.0f}s)")
+    track_ways()
+    log.info(f"Cropping: found ways inside area ({time.perf_counter() - start:.0f}s)")
+
+    # pass 2: tagged nodes inside the polygon, untagged nodes only matter as parts of ways
+    ids, lons, lats = [], [], []
+
+    def track_nodes():
+        inside = shapely.contains_xy(area, lons, lats)
+        for node_id in np.asarray(ids, dtype=np.int64)[inside]:
+            tracker.add_node(int(node_id))
+        ids.clear()
+        lons.clear()
+        lats.clear()
+
+    left, bottom, right, top = area.bounds
+    nodes = osmium.FileProcessor(source, osmium.osm.NODE).with_filter(osmium.filter.EmptyTagFilter())
+    for node in nodes:
+        location = node.location
+        if left <= location.lon <= right and bottom <= location.lat <= top:
+            ids.append(node.id)
+            lons.append(location.lon)
+            lats.append(location.lat)
+            if len(ids) >= batch_size:
+                track_nodes()
+    track_nodes()
+    log.info(f"Cropping: found tagged nodes inside area ({time.perf_counter() - start:.0f}s)")
+
+    # pass 3: relations using these objects
+    tracker.complete_forward_references(source, relation_depth=1)
+    log.info(f"Cropping: found relations ({time.perf_counter() - start:.0f}s)")
+
+    # pass 4: all nodes of the ways
+    tracker.complete_backward_references(source, relation_depth=0)
+    log.info(f"Cropping: completed ways ({time.perf_counter() - start:.0f}s)")
+
+    # pass 5: writing tracked objects, an interrupted crop must not be left under the final name
+    temporary_path = Path(target).with_suffix(".tmp.pbf")
+    temporary_path.unlink(missing_ok=True)
+    writer = osmium.WriteHandler(str(temporary_path))
+    try:
+        osmium.apply(source, tracker.id_filter(), writer)
+    finally:
+        writer.close()
+    temporary_path.replace(target)
+    log.info(f"Cropping: wrote {target} ({time.perf_counter() - start:.0f}s)")
+
+
+def extract_pois(
+    source: str,
+    filter: dict,
+    area: shapely.Geometry = None,
+    cache_dir: Path = cache.CACHE_DIR,
+) -> gpd.GeoDataFrame:
+    """
+    Extracts features matching a tag filter from an osm.pbf file as centroids, without loading the file.
+    Results are cached as GeoParquet keyed by the file's content, the filter and the bounds of area.
+    param: source: path of the osm.pbf file
+    param: filter: dict of tag keys and lists of accepted values or True for any value,
+        e.g. {"amenity": ["school"]}, a feature matching any key is kept
+    param: area: (Optional) shapely geometry in EPSG:4326, only features with a centroid in its bounds are kept
+    param: cache_dir: (Optional) directory in which a pois folder is created
+    return: gpd.GeoDataFrame with id, osm_type, osm_id, name and filter key columns and centroid geometries
+    """
+    bounds = None if area is None else [round(bound, 6) for bound in area.bounds]
+    key = hashlib.blake2b(digest_size=16)
+    key.update(cache.file_digest(source, cache_dir=cache_dir).encode())
+    key.update(json.dumps(filter, sort_keys=True).encode())
+    key.update(json.dumps(bounds).encode())
+    poi_path = Path(cache_dir, "pois", f"{key.hexdigest()}.parquet")
+
+    if poi_path.exists():
+        log.info(f"Loading cached destinations for {filter} from {poi_path}")
+        cache.touch(poi_path)
+        return gpd.read_parquet(poi_path)
+
+    pois = stream_pois(source, filter, bounds)
+    poi_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = poi_path.with_suffix(".tmp")
+    pois.to_parquet(temporary_path)
+    temporary_path.replace(poi_path)
+    return pois
+
+
+def stream_pois(source: str, filter: dict, bounds: list = None) -> gpd.GeoDataFrame:
+    """
+    Streams an osm.pbf file with pyosmium and returns centroids of the features matching a tag filter.
+    Only the node references of matching ways and multipolygons and the locations of those nodes are kept in memory.
+    param: source: path of the osm.pbf file
+    param: filter: dict of tag keys and lists of accepted values or True for any value
+    param: bounds: (Optional) left, bottom, right, top in EPSG:4326 the centroids have to be in
+    return: gpd.GeoDataFrame in EPSG:4326, see extract_pois
+    """
+    start = time.perf_counter()
+    columns = ["name", *[key for key in filter if key != "name"]]
+
+    def matches(tags) -> bool:
+        for key, values in filter.items():
+            value = tags.get(key)
+            if value is not None and (values is True or value in values):
+                return True
+        return False
+
+    # pass 1: tagged nodes, and node or member references of tagged ways and multipolygons
+    features = []
+    way_nodes = {}
+    relation_ways = {}
+    for osm_object in osmium.FileProcessor(source).with_filter(osmium.filter.KeyFilter(*filter)):
+        if not matches(osm_object.tags):
+            continue
+        if osm_object.is_node():
+            if not osm_object.location.valid():
+                continue
+            osm_type = "node"
+            geometry = shapely.Point(osm_object.location.lon, osm_object.location.lat)
+        elif osm_object.is_way():
+            osm_type = "way"
+            geometry = None
+            way_nodes[osm_object.id] = [node.ref for node in osm_object.nodes]
+        elif osm_object.is_relation() and osm_object.tags.get("type") == "multipolygon":
+            osm_type = "relation"
+            geometry = None
+            relation_ways[osm_object.id] = [
+                member.ref
+                for member in osm_object.members
+                if member.type == "w" and member.role != "inner"
+            ]
+        else:
+            continue
+        tags = {column: osm_object.tags.get(column) for column in columns}
+        features.append((osm_type, osm_object.id, tags, geometry))
+    log.info(f"Extracting destinations: found {len(features)} features ({time.perf_counter() - start:.0f}s)")
+
+    # pass 2: node references of the outer ways of multipolygons
+    member_ways = {
+        way_id for way_ids in relation_ways.values() for way_id in way_ids
+    } - set(way_nodes)
+    if member_ways:
+        tracker = osmium.IdTracker()
+        for way_id in member_ways:
+            tracker.add_way(way_id)
+        for way in osmium.FileProcessor(source, osmium.osm.WAY).with_filter(tracker.id_filter()):
+            way_nodes[way.id] = [node.ref for node in way.nodes]
+
+    # pass 3: locations of all referenced nodes
+    locations = {}
+    if way_nodes:
+        tracker = osmium.IdTracker()
+        for node_ids in way_nodes.values():
+            for node_id in node_ids:
+                tracker.add_node(node_id)
+        for node in osmium.FileProcessor(source, osmium.osm.NODE).with_filter(tracker.id_filter()):
+            if node.location.valid():
+                locations[node.id] = (node.location.lon, node.location.lat)
+    log.info(f"Extracting destinations: located {len(locations)} nodes ({time.perf_counter() - start:.0f}s)")
+
+    def line(way_id: int) -> list:
+        return [locations[node_id] for node_id in way_nodes.get(way_id, []) if node_id in locations]
+
+    records = []
+    for osm_type, osm_id, tags, geometry in features:
+        if osm_type == "way":
+            geometry = way_centroid(line(osm_id))
+        elif osm_type == "relation":
+            geometry = multipolygon_centroid([line(way_id) for way_id in relation_ways[osm_id]])
+        if geometry is None:
+            continue
+        if bounds is not None:
+            left, bottom, right, top = bounds
+            if not (left <= geometry.x <= right and bottom <= geometry.y <= top):
+                continue
+        records.append(
+            {"id": f"{osm_type}/{osm_id}", "osm_type": osm_type, "osm_id": osm_id, **tags, "geometry": geometry}
+        )
+
+    pois = gpd.GeoDataFrame(
+        records, columns=["id", "osm_type", "osm_id", *columns, "geometry"], geometry="geometry", crs="EPSG:4326"
+    )
+    log.info(f"Extracted {len(pois)} destinations for {filter} ({time.perf_counter() - start:.0f}s)")
+    return pois
+
+
+def way_centroid(coordinates: list) -> shapely.Point | None:
+    """Returns the centroid of a closed way as area, of an open way as line"""
+    if not coordinates:
+        return None
+    if len(coordinates) == 1:
+        return shapely.Point(coordinates[0])
+    if len(coordinates) >= 4 and coordinates[0] == coordinates[-1]:
+        polygon = shapely.Polygon(coordinates)
+        if polygon.area > 0:
+            return polygon.centroid
+    return shapely.LineString(coordinates).centroid
+
+
+def multipolygon_centroid(lines: list[list]) -> shapely.Point | None:
+    """Returns the centroid of the polygons formed by the outer ways of a multipolygon, or of the ways themselves"""
+    lines = [shapely.LineString(coordinates) for coordinates in lines if len(coordinates) >= 2]
+    if not lines:
+        return None
+    polygons = shapely.polygonize(lines)
+    if not polygons.is_empty and polygons.area > 0:
+        return polygons.centroid
+    return shapely.MultiLineString(lines).centroid
+
+
 class OSMIndex:
     """Class for index of osm data and associated operations"""
 
     def __init__(self, path: str = None) -> None:
+        """
+        param: path: (Optional) location of the SQLite index file
+        """
         self.path = path
         self.gdf = None
+        self.tree = None
         self.loaded = False
 
     def load_osm_fileindex(self) -> None:
         """Loads osm index into memory as a geopandas.GeoDataFrame"""
         log.info("Loading OSM file index.")
+        self.gdf = gpd.GeoDataFrame(
+            columns=["name", "path", "area", "source", "region", "geometry"],
+            geometry="geometry",
+            crs="EPSG:4326",
+        )
+        self.tree = None
+        self.loaded = True
         if self.path is None:
-            self.gdf = gpd.GeoDataFrame(
-                columns=["name", "path", "geometry"],
-                geometry="geometry",
-                crs="EPSG:4326",
-            )
-            self.loaded = True
             return
-        try:
-            self.gdf = gpd.read_file(self.path)
-        except fiona.errors.DriverError:
+
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT name, path, area, source, region, geometry FROM osm_files ORDER BY rowid"
+            ).fetchall()
+        if rows:
+            names, paths, areas, sources, regions, geometries = zip(*rows)
             self.gdf = gpd.GeoDataFrame(
-                columns=["name", "path", "geometry"],
-                geometry="geometry",
+                {"name": names, "path": paths, "area": areas, "source": sources, "region": regions},
+                geometry=shapely.from_wkb(geometries),
                 crs="EPSG:4326",
             )
-        self.loaded = True
 
-    def add_file(self, file: OSMFile) -> None:
+    def _connect(self) -> sqlite3.Connection:
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS osm_files "
+            "(name TEXT, path TEXT, area REAL, source TEXT, region TEXT, geometry BLOB)"
+        )
+        # indexes written before crops recorded their region
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(osm_files)")}
+        if "region" not in columns:
+            connection.execute("ALTER TABLE osm_files ADD COLUMN region TEXT")
+        return connection
+
+    def _insert(self, rows: gpd.GeoDataFrame) -> None:
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "INSERT INTO osm_files (name, path, area, source, region, geometry) VALUES (?, ?, ?, ?, ?, ?)",
+                zip(
+                    rows["name"],
+                    rows["path"],
+                    rows["area"],
+                    rows["source"],
+                    rows["region"],
+                    shapely.to_wkb(rows.geometry.values),
+                ),
+            )
+
+    def add_file(self, file: OSMFile, source: str = None, region: str = None) -> None:
         """
-        Append the currently loaded osm index with data from an OSMFile.
+        Append the currently loaded osm index with data from an OSMFile, replacing an entry with the same path.
+        The entry is written to the index file right away if it has a path.
         param: file: OSMFile object to add to the index
+        param: source: (Optional) content hash of the file a cropped OSMFile was cut from
+        param: region: (Optional) Geofabrik id of the download a cropped OSMFile was cut from
         """
         if not self.loaded:
             self.load_osm_fileindex()
 
+        if self.path is not None:
+            with closing(self._connect()) as connection, connection:
+                connection.execute("DELETE FROM osm_files WHERE path = ?", (str(file.path),))
+        self.gdf = self.gdf[self.gdf["path"] != str(file.path)]
+
         new_row = gpd.GeoDataFrame(
-            {"name": [file.name], "path": [file.path], "geometry": [file.extent]},
+            {
+                "name": [file.name],
+                "path": [str(file.path)],
+                "area": [shapely.area(file.extent)],
+                "source": [source],
+                "region": [region],
+                "geometry": [file.extent],
+            },
             crs="EPSG:4326",
         )
+        if self.path is not None:
+            self._insert(new_row)
         self.gdf = pd.concat([self.gdf, new_row], ignore_index=True)
+        self.tree = None
 
     def save_osmindex(self, path: str = None) -> None:
         """
-        Saves OSMIndex at specified location
-        param: path: save location (optional). If left unspecified overrites existing index.
+        Saves OSMIndex at specified location. Entries are already saved by add_file if the index has a path.
+        param: path: save location (optional). Only used if the index has no path yet.
         """
         if not self.loaded:
             self.load_osm_fileindex()
@@ -153,28 +460,98 @@ class OSMIndex:
                     message="Please, provide a file path to save to!"
                 )
             self.path = path
-        self.gdf.to_file(filename=self.path, driver="GeoJSON", crs="EPSG:4326")
+            self._insert(self.gdf)
+
+    def remove_missing(self) -> None:
+        """Removes entries whose files no longer exist, e.g. after cache eviction"""
+        if not self.loaded:
+            self.load_osm_fileindex()
 
-    def find_osm_file(self, gdf: gpd.GeoDataFrame) -> OSMFile:
+        missing = ~self.gdf["path"].map(os.path.exists).astype(bool)
+        if not missing.any():
+            return
+        if self.path is not None:
+            with closing(self._connect()) as connection, connection:
+                connection.executemany(
+                    "DELETE FROM osm_files WHERE path = ?",
+                    ((path,) for path in self.gdf.loc[missing, "path"]),
+                )
+        self.gdf = self.gdf[~missing].reset_index(drop=True)
+        self.tree = None
+
+    def current_downloads(self, cache_dir: Path = cache.CACHE_DIR) -> dict[str, str]:
+        """
+        Returns the content hashes of the indexed files that weren't cropped, i.e. the current downloads.
+        param: cache_dir: (Optional) directory holding the memo of file hashes
+        return: dict of content hashes by Geofabrik id
+        """
+        self.remove_missing()
+        downloads = self.gdf[self.gdf["source"].isna()]
+        return {
+            name: cache.file_digest(path, cache_dir=cache_dir)
+            for name, path in zip(downloads["name"], downloads["path"])
+        }
+
+    def lineage(self, file: OSMFile) -> tuple[str | None, str | None]:
+        """
+        Returns where an indexed OSMFile was cut from.
+        return: tuple of the content hash and Geofabrik id of the download, both None for downloads
+        """
+        rows = self.gdf[self.gdf["path"] == str(file.path)]
+        if rows.empty or pd.isna(rows.iloc[0]["source"]):
+            return None, None
+        region = rows.iloc[0]["region"]
+        return rows.iloc[0]["source"], None if pd.isna(region) else region
+
+    def source_download(self, file: OSMFile) -> OSMFile | None:
+        """
+        Returns the indexed download a cropped OSMFile was cut from.
+        return: OSMFile or None if the file isn't a crop or its download is gone
+        """
+        _, region = self.lineage(file)
+        if region is None:
+            return None
+        downloads = self.gdf[self.gdf["source"].isna() & (self.gdf["name"] == region)]
+        if downloads.empty:
+            return None
+        return OSMFile(
+            name=downloads.iloc[0]["name"],
+            path=downloads.iloc[0]["path"],
+            extent=downloads.iloc[0]["geometry"],
+        )
+
+    def find_osm_file(self, gdf: gpd.GeoDataFrame, downloads: dict[str, str] = None) -> OSMFile:
         """
         Searches smallest available index entry that covers the extent of another GeoDataFrame
         param: gdf: geopandas.GeoDataFrame to cover
+        param: downloads: (Optional) content hashes of the current downloads by Geofabrik id, see current_downloads.
+            Cropped entries cut from an older download of a region are skipped. Crops whose download
+            is no longer stored stay valid
         return: matching_file: OSMFile that matches criteria or None if none found
         """
-        if not self.loaded:
-            self.load_osm_fileindex
+        self.remove_missing()
 
         if self.gdf.empty:
             return None
 
-        matching_rows = self.gdf.contains(gdf.unary_union)
-
-        coverage = self.gdf[matching_rows]["geometry"].area
-        if coverage.empty:
+        if self.tree is None:
+            self.tree = shapely.STRtree(self.gdf.geometry.values)
+        matching_rows = self.tree.query(gdf.unary_union, predicate="within")
+        if downloads is not None:
+            current_source = self.gdf["region"].map(downloads)
+            current = (
+                self.gdf["source"].isna()
+                | (self.gdf["region"].notna() & current_source.isna())
+                | (self.gdf["source"] == current_source)
+                # crops indexed before their region was recorded
+                | (self.gdf["region"].isna() & self.gdf["source"].isin(list(downloads.values())))
+            )
+            matching_rows = matching_rows[current.to_numpy()[matching_rows]]
+        if len(matching_rows) == 0:
             # TODO output type
             return None
-        
-        smallest = coverage.idxmin()
+
+        smallest = matching_rows[np.argmin(self.gdf["area"].values[matching_rows])]
 
         matching_file = OSMFile(
             name=self.gdf.iloc[smallest]["name"],
@@ -185,58 +562,147 @@ class OSMIndex:
         return matching_file
 
 
+class GeofabrikCatalog:
+    """Class for the bundled Geofabrik download index with a spatial index for region lookups"""
+
+    def __init__(self, path: str = "geofabrik_downloadindex.json") -> None:
+        """
+        Loads the catalog from a pickled sidecar next to the index, which is created on first use.
+        param: path: location of the Geofabrik download index
+        """
+        path = Path(path)
+        sidecar = path.with_suffix(".pkl")
+        if sidecar.exists() and sidecar.stat().st_mtime >= path.stat().st_mtime:
+            with open(sidecar, "rb") as catalog_file:
+                self.ids, self.geometries = pickle.load(catalog_file)
+        else:
+            log.info("Converting Geofabrik download index")
+            geofabrik_available = gpd.read_file(path)
+            self.ids = geofabrik_available["id"].to_numpy()
+            self.geometries = geofabrik_available["geometry"].to_numpy()
+            with open(sidecar, "wb") as catalog_file:
+                pickle.dump((self.ids, self.geometries), catalog_file)
+
+        self.areas = shapely.area(self.geometries)
+        self.hulls = shapely.convex_hull(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def smallest_region(self, geometry: shapely.Geometry) -> tuple[str, shapely.Geometry]:
+        """
+        Finds the smallest region containing a geometry.
+        Candidates from the spatial index are checked from small to large against their
+        convex hulls first, so only few exact containment tests on full outlines are needed.
+        param: geometry: shapely geometry in EPSG:4326
+        return: tuple of the Geofabrik id and the region outline
+        """
+        candidates = self.tree.query(geometry)
+        for candidate in candidates[np.argsort(self.areas[candidates])]:
+            if not self.hulls[candidate].contains(geometry):
+                continue
+            if self.geometries[candidate].contains(geometry):
+                return self.ids[candidate], self.geometries[candidate]
+        raise ValueError("No Geofabrik region covers the requested area")
+
+
+@functools.cache
+def geofabrik_catalog(path: str = "geofabrik_downloadindex.json") -> GeofabrikCatalog:
+    """Returns the Geofabrik catalog, loaded once per process"""
+    return GeofabrikCatalog(path)
+
+
 def find_online_data(gdf: gpd.GeoDataFrame):
     """
-    Downloads an OSM dataset from geofabrik that covers the extent of the provided GeoDataFrame
+    Finds the smallest OSM dataset from geofabrik that covers the extent of the provided GeoDataFrame
     param: gdf: gpd.GeoDataFrame
-    return: return_data: OSMFile object
+    return: preferred_set, preferred_set_extent: Geofabrik id and outline of the dataset
     """
-
-    geofabrik_available = gpd.read_file("geofabrik_downloadindex.json")
-
-    # finding smallest available set covering gtfs feed
-    matching_datasets = geofabrik_available.contains(gdf.unary_union)
-    coverage = geofabrik_available[matching_datasets]["geometry"].area
-    smallest = coverage.idxmin()
-    preferred_set = geofabrik_available.iloc[smallest]["id"]
-    preferred_set_extent = geofabrik_available.iloc[smallest]["geometry"]
-
+    preferred_set, preferred_set_extent = geofabrik_catalog().smallest_region(
+        gdf.unary_union
+    )
     return preferred_set, preferred_set_extent
 
 
-def download_osm_data(id: str, extent):
+def download_osm_data(id: str, extent, directory: Path = Path(cache.CACHE_DIR, "osm_data")):
     # TODO Error Handling for pyrosm: ValueError("couldnt find url for xyz")
-    osm_path = pyrosm.get_data(dataset=id, directory="osm_data")
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    osm_path = pyrosm.get_data(dataset=id, directory=str(directory))
     return_data = OSMFile(path=osm_path, extent=extent, name=id)
 
     return return_data
 
 
-def get_osm_data(geodata: gpd.GeoDataFrame, name: str) -> OSMFile:
+def crop_name(source: str, geodata: gpd.GeoDataFrame) -> str:
+    """
+    Returns a name for a cropped extract unique to its source file and crop geometry.
+    param: source: content hash of the source file
+    param: geodata: gpd.GeoDataFrame the extract is cropped to
+    """
+    geometry = shapely.normalize(geodata.to_crs("EPSG:4326").unary_union)
+    geometry_hash = hashlib.blake2b(shapely.to_wkb(geometry), digest_size=8).hexdigest()
+    return f"{source[:16]}_{geometry_hash}"
+
+
+def get_osm_data(
+    geodata: gpd.GeoDataFrame,
+    name: str,
+    cache_dir: Path = cache.CACHE_DIR,
+    budget: int = 20 * 2**30,
+) -> OSMFile:
     """
     Acquires OSMdata either from local storage, or if no matching dataset is available by download from Geofabrik.
-    If the filesize is too large for easy processing, the dataset is cropped to match the bounds of the geodata.
+    If the filesize is too large for easy processing, the dataset is cropped to match the outline of the geodata.
+    Cropped extracts are indexed with their source and reused for any later area they cover,
+    unless a newer download of their region replaced the one they were cut from.
     ## Parameters
     geodata: gpd.GeoDataFrame to whoose bounds the OSM data is matched.
-    name: name under which a potentially cropped OSM data file is stored.
+    name: name of the place, used in log messages.
+    cache_dir: directory holding the OSM index, the osm_data folder of extracts and the memo of file hashes.
+    budget: maximum size of the osm_data folder in bytes, least recently used extracts are deleted beyond it.
     ## Return
     matching_file: file matching the extent of the provided GeoDataFrame.
     """
-    index = OSMIndex(path="osm_data.json")
+    osm_dir = Path(cache_dir, "osm_data")
+    index = OSMIndex(path=Path(cache_dir, "osm_data.sqlite"))
     index.load_osm_fileindex()
 
-    local_file = index.find_osm_file(gdf=geodata)
+    local_file = index.find_osm_file(
+        gdf=geodata, downloads=index.current_downloads(cache_dir=cache_dir)
+    )
     osm_file_id, osm_file_extent = find_online_data(gdf=geodata)
 
     if local_file is None or local_file.extent.area > osm_file_extent.area:
-        matching_file = download_osm_data(id=osm_file_id, extent=osm_file_extent)
+        with instrumentation.span("osm_download", region=osm_file_id):
+            matching_file = download_osm_data(
+                id=osm_file_id, extent=osm_file_extent, directory=osm_dir
+            )
         index.add_file(matching_file)
     else:
+        log.info(f"Reusing local osm data {local_file.name} for {name}")
         matching_file = local_file
+    cache.touch(matching_file.path)
+    in_use = [matching_file.path]
+    # the download a reused crop was cut from is kept, so areas the crop doesn't cover can be cut from it
+    source_file = index.source_download(matching_file)
+    if source_file is not None:
+        cache.touch(source_file.path)
+        in_use.append(source_file.path)
 
     if os.path.getsize(matching_file.path) > 700000000:
-        matching_file.crop(geodata, name, inplace=True)
-        index.add_file(matching_file)
+        # crops of a crop are attributed to the download the first crop was cut from
+        source, region = index.lineage(matching_file)
+        if source is None:
+            source = cache.file_digest(matching_file.path, cache_dir=cache_dir)
+            region = matching_file.name
+        with instrumentation.span(
+            "osm_crop", source_bytes=os.path.getsize(matching_file.path)
+        ) as counts:
+            matching_file.crop(
+                geodata, crop_name(source, geodata), inplace=True, directory=osm_dir
+            )
+            counts["cropped_bytes"] = os.path.getsize(matching_file.path)
+        index.add_file(matching_file, source=source, region=region)
+        in_use.append(matching_file.path)
 
-    index.save_osmindex(path="osm_data.json")
+    cache.evict_lru(osm_dir, budget=budget, pattern="*.osm.pbf", keep=in_use)
+    index.remove_missing()
     return matching_file
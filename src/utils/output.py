@@ -1,11 +1,79 @@
+import shutil
+import logging as log
 import geopandas as gpd
-from matplotlib import pyplot as plt
+import pandas as pd
+import utils.instrumentation as instrumentation
+from pathlib import Path
 
 
 def to_png(name: str, county: str, results: gpd.GeoDataFrame):
+    # matplotlib is only needed for plotting, not for writing results
+    from matplotlib import pyplot as plt
+
     results.plot(column="mean", cmap="magma_r", legend=True)
     plt.savefig(f"/home/emily/thesis_BA/data/output/{name}_{county}.png")
     plt.close
 
 
-# TODO add geojson export
+class ResultWriter:
+    """Class writing hexgrid results to GeoParquet, with metric columns saved as they finish"""
+
+    def __init__(
+        self,
+        name: str,
+        hexgrid: gpd.GeoDataFrame,
+        directory: str = "/data/output",
+        geojson: bool = False,
+    ) -> None:
+        """
+        Writes cell ids and geometries once to a parts folder next to the final output.
+        param: name: name of the output file without suffix
+        param: hexgrid: gpd.GeoDataFrame with an id column
+        param: directory: output folder
+        param: geojson: (Optional) if True finish also writes a GeoJSON file for compatibility
+        """
+        self.name = name
+        self.directory = Path(directory)
+        self.parts = Path(directory, f"{name}.parts")
+        self.geojson = geojson
+        self.columns = []
+
+        self.parts.mkdir(parents=True, exist_ok=True)
+        hexgrid.to_parquet(Path(self.parts, "hexgrid.parquet"))
+
+    def add(self, result: pd.DataFrame) -> None:
+        """
+        Saves every column of a result indexed by cell id. Safe to call from worker threads.
+        param: result: pd.DataFrame indexed by cell id, e.g. from centrality.closeness_metrics
+        """
+        for column in result.columns:
+            result[[column]].to_parquet(Path(self.parts, f"{column}.parquet"))
+            self.columns.append(column)
+
+    def finish(self, columns: list[str] = None) -> Path:
+        """
+        Joins all saved columns onto the hexgrid in one pass and writes the final output.
+        param: columns: (Optional) order of the metric columns, defaults to the order they were added
+        return: path to the GeoParquet file
+        """
+        if columns is None:
+            columns = self.columns
+
+        with instrumentation.span("output_write", output=self.name, columns=len(columns)) as counts:
+            results = gpd.read_parquet(Path(self.parts, "hexgrid.parquet"))
+            if columns:
+                metrics = pd.concat(
+                    [pd.read_parquet(Path(self.parts, f"{column}.parquet")) for column in columns],
+                    axis=1,
+                )
+                results = results.join(other=metrics, on="id")
+
+            path = Path(self.directory, f"{self.name}.parquet")
+            results.to_parquet(path)
+            if self.geojson:
+                results.to_file(Path(self.directory, f"{self.name}.json"))
+            counts["cells"] = len(results)
+        log.info(f"Saved results to {path}")
+
+        shutil.rmtree(self.parts)
+        return path
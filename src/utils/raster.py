@@ -1,12 +1,25 @@
+import warnings
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 import rasterio as rio
 import logging as log
+import h3
+import json
+import hashlib
+import utils.cache as cache
+import utils.instrumentation as instrumentation
 from pathlib import Path
 from shapely.geometry import mapping
 from rasterio.mask import mask
+from rasterio.merge import merge
+from rasterio.windows import from_bounds
 from rasterio.features import shapes
 
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    from h3.unstable import vect
+
 def gdf_to_data_raster(place: gpd.GeoDataFrame, data: Path) -> gpd.GeoDataFrame|None:
     geometry = place.unary_union.convex_hull
     feature = [mapping(geometry)]
@@ -36,3 +49,108 @@ def gdf_to_data_raster(place: gpd.GeoDataFrame, data: Path) -> gpd.GeoDataFrame|
 
     
 
+
+
+
+def population_tiles(data: Path) -> list[Path]:
+    """
+    Returns the raster tiles of a population data set.
+    param: data: path to a single raster, a VRT mosaic or a directory of GeoTIFF tiles
+    return: list of raster paths
+    """
+    data = Path(data)
+    if data.is_dir():
+        return sorted(data.glob("*.tif"))
+    return [data]
+
+
+def read_population_window(
+    place: gpd.GeoDataFrame, data: Path, cache_dir: Path = cache.CACHE_DIR
+) -> tuple[np.ndarray, rio.Affine] | None:
+    """
+    Reads the window of population raster covering the bounds of a place.
+    Only tiles intersecting the place are opened and only the matching window is read.
+    Windows are cached on disk as float32 arrays and memory mapped on reuse. They are keyed by the content
+    of every file a tile reads, so updating a tile referenced by a VRT mosaic invalidates them.
+    param: place: GeoDataFrame in EPSG:4326 with the area to read
+    param: data: path to a single raster, a VRT mosaic or a directory of GeoTIFF tiles
+    param: cache_dir: directory in which a population folder is created
+    return: tuple of the population array with 0 for no data and its affine transform, None if nothing overlaps
+    """
+    left, bottom, right, top = place.total_bounds
+    tiles = []
+    files = set()
+    for tile in population_tiles(data):
+        with rio.open(tile) as source:
+            tile_bounds = source.bounds
+            # a VRT lists the rasters it references besides itself
+            tile_files = source.files
+        if tile_bounds.left < right and tile_bounds.right > left and tile_bounds.bottom < top and tile_bounds.top > bottom:
+            tiles.append(tile)
+            files.update(Path(file).absolute() for file in tile_files)
+    if not tiles:
+        log.warn(msg='Could not find raster data matching the location. Continuing without.')
+        return None
+
+    key = hashlib.blake2b(digest_size=16)
+    for file in sorted(files):
+        key.update(cache.file_digest(file, cache_dir=cache_dir).encode())
+    key.update(np.round(place.total_bounds, 6).tobytes())
+    window_path = Path(cache_dir, "population", f"{key.hexdigest()}.npy")
+    transform_path = window_path.with_suffix(".json")
+
+    if window_path.exists() and transform_path.exists():
+        log.info(msg=f'Loading cached population window from {window_path}')
+        cache.touch(window_path)
+        transform = rio.Affine(*json.loads(transform_path.read_text()))
+        return np.load(window_path, mmap_mode="r"), transform
+
+    log.info(msg=f'Reading population window from {len(tiles)} tile(s)')
+    with instrumentation.span("raster_window", tiles=len(tiles)) as counts:
+        if len(tiles) == 1:
+            with rio.open(tiles[0]) as source:
+                window = from_bounds(left, bottom, right, top, transform=source.transform)
+                window = window.round_offsets(op="floor").round_lengths(op="ceil")
+                image = source.read(1, window=window, boundless=True, fill_value=0, out_dtype=np.float32)
+                transform = source.window_transform(window)
+        else:
+            mosaic, transform = merge(tiles, bounds=(left, bottom, right, top), nodata=0, dtype="float32")
+            image = mosaic[0]
+        image = np.where(image > 0, image, 0).astype(np.float32)
+        counts["pixels"] = image.size
+
+    window_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(window_path, image)
+    transform_path.write_text(json.dumps(list(transform)[:6]))
+    return image, transform
+
+
+def population_per_cell(
+    place: gpd.GeoDataFrame, data: Path, resolution: int = 9, cache_dir: Path = cache.CACHE_DIR
+) -> pd.Series:
+    """
+    Sums the population of raster pixels per H3 cell by mapping pixel centres to cell ids.
+    param: place: GeoDataFrame in EPSG:4326 with the area to read
+    param: data: path to the population raster(s) in EPSG:4326, see read_population_window
+    param: resolution: H3 resolution of the cells
+    param: cache_dir: directory for cached raster windows
+    return: pd.Series with population indexed by H3 cell id
+    """
+    population_window = read_population_window(place, data, cache_dir=cache_dir)
+    if population_window is None:
+        return pd.Series(dtype=float)
+    band, out_transform = population_window
+
+    rows, cols = np.nonzero(band > 0)
+    xs = out_transform.c + (cols + 0.5) * out_transform.a + (rows + 0.5) * out_transform.b
+    ys = out_transform.f + (cols + 0.5) * out_transform.d + (rows + 0.5) * out_transform.e
+
+    cells = vect.geo_to_h3(ys, xs, resolution)
+    unique_cells, cell_index = np.unique(cells, return_inverse=True)
+    population = np.bincount(cell_index, weights=band[rows, cols].astype(np.float64))
+
+    return pd.Series(
+        population,
+        index=pd.Index([h3.h3_to_string(int(cell)) for cell in unique_cells], name="id"),
+        name="population",
+    )
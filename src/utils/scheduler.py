@@ -0,0 +1,45 @@
+import logging as log
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
+
+def worker_count(workers: int = None) -> int:
+    """
+    Resolves the number of workers for the scheduler.
+    param: workers: requested number of workers, None or 0 uses every available core
+    return: number of worker threads
+    """
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+
+def run_tasks(tasks: list[tuple[str, Callable[[], object]]], workers: int = 1) -> list:
+    """
+    Runs labelled tasks on a pool of worker threads, e.g. departure times of several places.
+    param: tasks: list of tuples of a label for progress messages and a callable without arguments
+    param: workers: number of worker threads, None or 0 uses every available core
+    return: results in the order of tasks
+    """
+    workers = min(worker_count(workers), max(1, len(tasks)))
+    log.info(f"Scheduling {len(tasks)} tasks on {workers} workers")
+
+    start = time.perf_counter()
+    results = [None] * len(tasks)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(task): position
+            for position, (_, task) in enumerate(tasks)
+        }
+        for finished, future in enumerate(as_completed(futures), start=1):
+            position = futures[future]
+            results[position] = future.result()
+            elapsed = time.perf_counter() - start
+            log.info(
+                f"Finished {tasks[position][0]} "
+                f"({finished}/{len(tasks)}, {elapsed:.0f}s elapsed)"
+            )
+
+    return results